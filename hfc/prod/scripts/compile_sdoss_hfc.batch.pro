@@ -17,4 +17,5 @@
 .compile sdoss_hfc_load_meta
 .compile sdoss_hfc_config__define
 .compile sdoss_hfc_parse_config
-.compile sdoss_hfc_processing
\ No newline at end of file
+.compile sdoss_hfc_processing
+.compile sdoss_hfc_worker
@@ -23,3 +23,13 @@ save, /ROUTINES, filename=filename, $
       /VERBOSE, /EMBEDDED, /COMPRESS
 if (file_test(filename)) then print,filename+' saved' $
 else message,filename+' cannot be saved!'
+
+proname= ['sdoss_hfc_worker']
+resolve_all, /CONTINUE_ON_ERROR, resolve_procedure=proname
+filename = target_dir+sep+'sdoss_hfc_worker.sav'
+
+save, /ROUTINES, filename=filename, $
+      description='Runtime IDL program to run sdoss_hfc_processing.pro as a resident worker', $
+      /VERBOSE, /EMBEDDED, /COMPRESS
+if (file_test(filename)) then print,filename+' saved' $
+else message,filename+' cannot be saved!'
@@ -0,0 +1,1148 @@
+#!/usr/bin/env python
+# -*- coding: ASCII -*-
+
+"""
+Module containing classes for sdoss_hfc_processing.py script.
+@author: X.Bonnin (LESIA, CNRS)
+"""
+
+import os
+import sys
+import re
+import shutil
+import threading
+import subprocess
+import sqlite3
+import multiprocessing
+import json
+import Queue
+import collections
+import time
+from datetime import datetime
+
+# Import sdoss hfc global variables
+try:
+    from sdoss_hfc_globals import LOG, PJOBS, DJOBS, PREFETCH, BATCH_SIZE, \
+        IDL_EXE_PATH, SDOSS_IDL_WORKER_BIN, WORKER_RECYCLE, IDL_TIMEOUT, \
+        INPUT_TFORMAT, JSOC_TFORMAT, EXPORT_TIMEOUT, JSOC_COMPRESS, LATENCY_BUDGET
+except:
+    sys.exit("Import failed in module sdoss_hfc_classes :\
+             \n\tsdoss_hfc_globals module is required!")
+
+try:
+    from jsoclib import jsoc, record_filename
+except:
+    sys.exit("Import failed in module sdoss_hfc_classes :\
+              \n\tjsoclib module is required!")
+
+try:
+    from hostpool import breaker_states
+except:
+    sys.exit("Import failed in module sdoss_hfc_classes :\
+              \n\thostpool module is required!")
+
+__version__ = "1.0"
+#__license__ = ""
+__author__ = "Xavier Bonnin (LESIA, CNRS)"
+#__credit__=[""]
+#__maintainer__=""
+__email__ = "xavier.bonnin@obspm.fr"
+__date__ = "21-FEB-2014"
+
+
+class sdoss_pipeline:
+
+    """
+    Two-stage pipeline to run sdoss jobs.
+
+    The download stage (djobs threads) calls job.download() and puts
+    the jobs ready to be processed in a queue bounded to prefetch items.
+    The idl stage (pjobs threads) takes them from this queue and calls
+    job.run(). job.end() is called once for every job, whatever its
+    outcome.
+    If a worker_factory is given, each idl thread owns the resident
+    idl worker returned by worker_factory(thread index), and passes it
+    to job.run(worker=...).
+    If batch_size is greater than 1, each idl thread takes up to
+    batch_size ready jobs at once and passes them to
+    batch_runner(jobs, worker=...).
+    If a concurrency controller is given, djobs and pjobs are the
+    numbers of threads, and the number of them actually running
+    a download or an idl job is set by the controller, which
+    observes every terminated job.
+    """
+
+    def __init__(self, pjobs=PJOBS, djobs=DJOBS, prefetch=PREFETCH,
+                 worker_factory=None,
+                 batch_size=BATCH_SIZE, batch_runner=None,
+                 controller=None):
+        self.pjobs = max(pjobs, 1)
+        self.djobs = max(djobs, 1)
+        self.prefetch = max(prefetch, 1)
+        self.worker_factory = worker_factory
+        self.batch_size = max(batch_size, 1)
+        self.batch_runner = batch_runner
+        if (self.batch_runner is None):
+            self.batch_size = 1
+        self.download_queue = Queue.Queue()
+        self.ready_queue = Queue.Queue(
+            maxsize=max(self.prefetch, self.batch_size))
+        self.done_queue = Queue.Queue()
+        self.workers = []
+        self.controller = controller
+        self.download_gate = None
+        self.idl_gate = None
+        if (controller is not None):
+            self.download_gate = controller.download_gate
+            self.idl_gate = controller.idl_gate
+
+    def _download_worker(self):
+        while True:
+            job = self.download_queue.get()
+            if (job is None):
+                break
+            if (self.download_gate is not None):
+                self.download_gate.acquire()
+            try:
+                ready = job.download()
+            except Exception as e:
+                LOG.error("Job[#%i]: %s", job.thread_id, str(e))
+                ready = False
+            finally:
+                if (self.download_gate is not None):
+                    self.download_gate.release()
+            if (ready):
+                # Blocks while prefetch filesets are already waiting
+                self.ready_queue.put(job)
+            else:
+                self._terminate(job)
+
+    def _idl_worker(self, index):
+        worker = None
+        try:
+            running = True
+            while (running):
+                job = self.ready_queue.get()
+                if (job is None):
+                    break
+                if (self.idl_gate is not None):
+                    self.idl_gate.acquire()
+                try:
+                    # The resident worker is started with the first job
+                    if (worker is None) and \
+                            (self.worker_factory is not None):
+                        worker = self.worker_factory(index)
+                    running = self._idl_jobs(job, worker)
+                finally:
+                    if (self.idl_gate is not None):
+                        self.idl_gate.release()
+        finally:
+            if (worker is not None):
+                worker.stop()
+
+    def _idl_jobs(self, job, worker):
+        if (self.batch_size == 1):
+            try:
+                if (worker is None):
+                    job.run()
+                else:
+                    job.run(worker=worker)
+            except Exception as e:
+                LOG.error("Job[#%i]: %s", job.thread_id, str(e))
+            self._terminate(job)
+            return True
+
+        # Complete the batch with the jobs already waiting
+        running = True
+        batch = [job]
+        while (len(batch) < self.batch_size):
+            try:
+                job = self.ready_queue.get_nowait()
+            except Queue.Empty:
+                break
+            if (job is None):
+                running = False
+                break
+            batch.append(job)
+        try:
+            self.batch_runner(batch, worker=worker)
+        except Exception as e:
+            LOG.error("Job[#%s]: %s",
+                      ",".join([str(job.thread_id) for job in batch]),
+                      str(e))
+        for job in batch:
+            self._terminate(job)
+        return running
+
+    def _terminate(self, job):
+        try:
+            job.end()
+        except Exception as e:
+            LOG.error("Job[#%i]: %s", job.thread_id, str(e))
+        if (self.controller is not None):
+            try:
+                self.controller.observe(job,
+                                        waiting=self.ready_queue.qsize())
+            except Exception as e:
+                LOG.error("Concurrency controller: %s", str(e))
+        self.done_queue.put(job)
+
+    def _start(self):
+        targets = [(self._download_worker, ())] * self.djobs + \
+            [(self._idl_worker, (i + 1,)) for i in range(self.pjobs)]
+        for target, args in targets:
+            worker = threading.Thread(target=target, args=args)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def _stop(self):
+        for i in range(self.djobs):
+            self.download_queue.put(None)
+        for i in range(self.pjobs):
+            self.ready_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def run(self, jobs):
+
+        """
+        Run the given jobs, yielding each of them as soon as
+        it has terminated.
+        """
+
+        self._start()
+        try:
+            for job in jobs:
+                self.download_queue.put(job)
+            for i in range(len(jobs)):
+                yield self.done_queue.get()
+        finally:
+            self._stop()
+
+
+class adaptive_gate:
+
+    """
+    Counting gate, like a semaphore, whose limit can be changed
+    while threads are waiting on it.
+    """
+
+    def __init__(self, limit):
+        self.limit = max(limit, 1)
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while (self.active >= self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = max(limit, 1)
+            self.condition.notify_all()
+
+
+class concurrency_controller:
+
+    """
+    Adaptive number of running downloads and idl jobs.
+
+    The terminated jobs are observed by windows of window jobs.
+    At the end of each window:
+      - the number of downloads is halved if a download has failed or
+        has fallen back to vso (http errors, timeouts), decreased by
+        one if the mean jsoc exp_status wait has doubled, or if the
+        last increase has not raised the download rate by 5 percent,
+        kept for one window after a decrease, and increased by one
+        otherwise.
+      - the number of idl jobs is decreased by one if the load average
+        of the node is over its number of cpus, and increased by one
+        if filesets are waiting for idl while the load is under
+        80 percent of the cpus.
+    Both numbers stay within [*_min, *_max].
+    """
+
+    def __init__(self, djobs_max=DJOBS, pjobs_max=PJOBS,
+                 djobs_min=1, pjobs_min=1, window=4):
+        self.djobs_min = max(djobs_min, 1)
+        self.djobs_max = max(djobs_max, self.djobs_min)
+        self.pjobs_min = max(pjobs_min, 1)
+        self.pjobs_max = max(pjobs_max, self.pjobs_min)
+        self.window = max(window, 1)
+        self.download_gate = adaptive_gate(self.djobs_min)
+        self.idl_gate = adaptive_gate(self.pjobs_min)
+        try:
+            self.ncpu = multiprocessing.cpu_count()
+        except NotImplementedError:
+            self.ncpu = 1
+        self.lock = threading.Lock()
+        self.jobs = []
+        self.window_start = time.time()
+        self.last_rate = None
+        self.last_wait = None
+        self.last_step = 0
+
+    def _failed_download(self, job):
+        # vso_fallback is only recorded when the JSOC download has
+        # failed, the hedged VSO downloads being vso_download
+        stages = job.stages
+        if ("vso_fallback" in stages):
+            return True
+        return (not job.success) and ("idl" not in stages)
+
+    def _load(self):
+        try:
+            return os.getloadavg()[0] / float(self.ncpu)
+        except OSError:
+            return 0.0
+
+    def observe(self, job, waiting=0):
+
+        """
+        Add a terminated job to the current window, and adjust
+        the limits if the window is complete. waiting is the
+        number of downloaded filesets waiting for idl.
+        """
+
+        with self.lock:
+            self.jobs.append(job)
+            if (len(self.jobs) < self.window):
+                return
+            jobs = self.jobs
+            elapsed = max(time.time() - self.window_start, 1.0e-6)
+            self.jobs = []
+            self.window_start = time.time()
+
+            nerror = len([job for job in jobs if self._failed_download(job)])
+            nbytes = 0
+            for job in jobs:
+                for stage in ["ic_download", "m_download"]:
+                    current = job.stages.get(stage, {})
+                    if (current.get("source") in ["jsoc", "vso"]):
+                        nbytes += current.get("bytes", 0)
+            rate = nbytes / elapsed
+            wait = sum([job.stages.get("exp_status", {}).get("sec", 0.0)
+                        for job in jobs]) / len(jobs)
+
+            djobs = self.download_gate.limit
+            if (nerror > 0):
+                djobs = djobs // 2
+            elif (self.last_wait) and (wait > 2.0 * self.last_wait):
+                djobs -= 1
+            elif (self.last_step > 0) and (self.last_rate is not None) and \
+                    (rate < 1.05 * self.last_rate):
+                djobs -= 1
+            elif (self.last_step >= 0):
+                djobs += 1
+            djobs = min(max(djobs, self.djobs_min), self.djobs_max)
+            self.last_step = djobs - self.download_gate.limit
+            self.last_rate = rate
+            self.last_wait = wait
+
+            load = self._load()
+            pjobs = self.idl_gate.limit
+            if (load > 1.0):
+                pjobs -= 1
+            elif (waiting > 0) and (load < 0.8):
+                pjobs += 1
+            pjobs = min(max(pjobs, self.pjobs_min), self.pjobs_max)
+
+            if (djobs != self.download_gate.limit) or \
+                    (pjobs != self.idl_gate.limit):
+                LOG.info("Concurrency: %i download(s), %i idl job(s) "
+                         "(%.2f MB/s, %i error(s), jsoc wait %.1f sec., "
+                         "load %.2f)", djobs, pjobs, rate / 1.0e6, nerror,
+                         wait, load)
+            self.download_gate.set_limit(djobs)
+            self.idl_gate.set_limit(pjobs)
+
+
+class jsoc_export:
+
+    """
+    Single jsoc export of the records of the dataseries ds between
+    starttime and endtime (at the given cadence), shared by the jobs
+    of these records.
+    The export is requested by the first job which needs one of its
+    urls; the other jobs wait for it, then all of them can download
+    their files.
+    """
+
+    # T_REC in a record name, e.g. hmi.Ic_45s_nrt[2014.02.21_00:00:00_TAI]
+    TREC_PATTERN = re.compile(r"\[(\d{4}\.\d{2}\.\d{2}_\d{2}:\d{2}:\d{2})")
+
+    def __init__(self, ds, starttime, endtime, cadence=None,
+                 timeout=EXPORT_TIMEOUT, notify=None,
+                 compress=JSOC_COMPRESS):
+        self.ds = ds
+        self.compress = compress
+        self.starttime = starttime
+        self.endtime = endtime
+        self.cadence = cadence
+        self.timeout = timeout
+        self.notify = notify
+        self.urls = None
+        self.lock = threading.Lock()
+
+    def _export(self, job=None):
+        LOG.info("Exporting %s records between %s and %s",
+                 self.ds, str(self.starttime), str(self.endtime))
+        j_soc = jsoc(self.ds, realtime=True, starttime=self.starttime,
+                     endtime=self.endtime, cadence=self.cadence,
+                     notify=self.notify, compress=self.compress)
+        try:
+            urls = j_soc.export(timeout=self.timeout)
+        except Exception as e:
+            LOG.error("Export of %s has failed: %s", self.ds, str(e))
+            urls = {}
+        if (job is not None):
+            job.add_stage("exp_request", j_soc.timing.get("exp_request", 0.0))
+            job.add_stage("exp_status", j_soc.timing.get("exp_status", 0.0))
+        self.urls = {}
+        for record, url in urls.items():
+            t_rec = self.TREC_PATTERN.search(record)
+            if (t_rec is not None):
+                self.urls[t_rec.group(1)] = (url, record_filename(record))
+        LOG.info("%i %s file(s) exported", len(self.urls), self.ds)
+
+    def get_url(self, date_obs, job=None):
+
+        """
+        Returns the download url and the local filename of the record
+        at date_obs, or (None, None) if it has not been exported.
+        The export time is added to the stages of job, if the
+        export is requested for it.
+        """
+
+        with self.lock:
+            if (self.urls is None):
+                self._export(job=job)
+        return self.urls.get(date_obs.strftime(JSOC_TFORMAT), (None, None))
+
+
+class mirror_run(threading.Thread):
+
+    """
+    Download of a file from a mirror, run by a mirror_hedge.
+    function(cancel, started) returns the downloaded file or "",
+    calling started.set() when the mirror starts sending the file.
+    """
+
+    def __init__(self, mirror, function, events, lock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.mirror = mirror
+        self.function = function
+        self.events = events
+        self.lock = lock
+        self.cancel = threading.Event()
+        self.t0 = time.time()
+        self.latency = None
+        self.finished = False
+        self.target = ""
+
+    def set(self):
+        if (self.latency is None):
+            self.latency = time.time() - self.t0
+            self.events.put(("started", self))
+
+    def run(self):
+        try:
+            target = self.function(self.cancel, self)
+        except Exception as e:
+            LOG.error("Download from %s has failed: %s", self.mirror, str(e))
+            target = ""
+        with self.lock:
+            self.finished = True
+            if (self.cancel.is_set()):
+                remove_file(target)
+                target = ""
+            self.target = target
+        self.events.put(("done", self))
+
+
+def remove_file(filename):
+
+    """Removes filename if it exists."""
+
+    if (filename) and (os.path.isfile(filename)):
+        os.remove(filename)
+
+
+class mirror_hedge:
+
+    """
+    Hedged download of a file from several mirrors.
+
+    The primary mirror is the one with the lowest median latency (time
+    until it starts sending the file) over the last window downloads.
+    If it has not started sending the file within budget sec., the next
+    mirror is launched as well, and the first complete download is kept,
+    the other ones being cancelled. A mirror which fails launches the
+    next one at once. The latency history is shared by all the jobs.
+    """
+
+    def __init__(self, budget=LATENCY_BUDGET, window=20):
+        self.budget = float(budget)
+        self.window = window
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def observe(self, mirror, latency):
+
+        """Adds the latency in sec. of a download from mirror."""
+
+        with self.lock:
+            history = self.latencies.setdefault(
+                mirror, collections.deque(maxlen=self.window))
+            history.append(latency)
+
+    def latency(self, mirror):
+
+        """
+        Returns the median latency of mirror, or the budget
+        if there is no download from it yet.
+        """
+
+        with self.lock:
+            history = list(self.latencies.get(mirror, []))
+        if not (history):
+            return self.budget
+        return percentile(history, 50)
+
+    def rank(self, mirrors):
+
+        """Sorts the mirrors by latency, keeping the given order on ties."""
+
+        return sorted(mirrors, key=self.latency)
+
+    def fetch(self, functions, job_id=0):
+
+        """
+        Downloads a file from the first mirror of the list of
+        (mirror, function) which completes it (see mirror_run).
+        Returns the downloaded file and its mirror, or ("", None).
+        """
+
+        ranked = self.rank([mirror for mirror, function in functions])
+        functions = dict(functions)
+        pending = list(ranked)
+        events = Queue.Queue()
+        lock = threading.Lock()
+        runs = []
+
+        def launch():
+            mirror = pending.pop(0)
+            run = mirror_run(mirror, functions[mirror], events, lock)
+            runs.append(run)
+            run.start()
+
+        launch()
+        deadline = time.time() + self.budget
+        running = 1
+        while (running > 0):
+            streaming = [run for run in runs if run.latency is not None]
+            if (pending) and not (streaming):
+                timeout = max(deadline - time.time(), 0.0)
+            else:
+                # Blocking Queue.get cannot be interrupted in python 2
+                timeout = 3600.0
+            try:
+                event, run = events.get(timeout=timeout)
+            except Queue.Empty:
+                if (pending) and not (streaming):
+                    LOG.info("Job[#%i]: %s has not started within %.1f sec., "
+                             "trying %s as well", job_id, runs[-1].mirror,
+                             self.budget, pending[0])
+                    launch()
+                    running += 1
+                    deadline = time.time() + self.budget
+                continue
+            if (event == "started"):
+                self.observe(run.mirror, run.latency)
+                continue
+            running -= 1
+            if (run.target):
+                if (run.latency is None):
+                    self.observe(run.mirror, time.time() - run.t0)
+                self._cancel(runs, run)
+                return run.target, run.mirror
+            # A failed mirror ranks behind the mirrors which answer
+            if (run.latency is None):
+                self.observe(run.mirror, time.time() - run.t0 + self.budget)
+            if (pending):
+                launch()
+                running += 1
+                deadline = time.time() + self.budget
+        return "", None
+
+    def _cancel(self, runs, winner):
+        with winner.lock:
+            for run in runs:
+                if (run is winner):
+                    continue
+                run.cancel.set()
+                if (run.latency is None) and \
+                        (time.time() - run.t0 >= self.budget):
+                    self.observe(run.mirror, time.time() - run.t0)
+                if (run.finished) and (run.target != winner.target):
+                    remove_file(run.target)
+                    run.target = ""
+
+
+class idl_worker:
+
+    """
+    Resident idl process running the sdoss_hfc_worker runtime.
+
+    Each request is sent as a line of tab-separated sdoss_hfc_processing
+    arguments on the worker stdin, and the worker answers with a
+    'SDOSS_WORKER DONE|ERROR' line on its stdout.
+    The process is restarted if it dies, stops answering the health
+    check or has processed recycle filesets.
+    """
+
+    def __init__(self, worker_id,
+                 idl_exe_path=IDL_EXE_PATH,
+                 sdoss_idl_worker_bin=SDOSS_IDL_WORKER_BIN,
+                 recycle=WORKER_RECYCLE,
+                 timeout=IDL_TIMEOUT,
+                 ping_timeout=120):
+
+        self.worker_id = worker_id
+        self.idl_exe_path = idl_exe_path
+        self.sdoss_idl_worker_bin = sdoss_idl_worker_bin
+        self.recycle = recycle
+        self.timeout = timeout
+        self.ping_timeout = ping_timeout
+        self.process = None
+        self.lines = None
+        self.nprocessed = 0
+
+    def _reader(self, stream, lines):
+        for line in iter(stream.readline, ''):
+            lines.put(line.rstrip("\n"))
+        lines.put(None)
+
+    def _kill(self):
+        try:
+            self.process.kill()
+        except OSError:
+            # Already terminated
+            pass
+
+    def _send(self, request):
+        self.process.stdin.write(request + "\n")
+        self.process.stdin.flush()
+
+    def _wait(self, timeout):
+
+        """
+        Wait for the next status line of the worker.
+        Returns the status and the output lines printed before it.
+        """
+
+        output = []
+        while True:
+            try:
+                line = self.lines.get(timeout=timeout)
+            except Queue.Empty:
+                return "TIMEOUT", output
+            if (line is None):
+                return "EXIT", output
+            if (line.startswith("SDOSS_WORKER ")):
+                return line[len("SDOSS_WORKER "):], output
+            output.append(line)
+
+    def start(self):
+        idl_cmd = [self.idl_exe_path, "-quiet",
+                   "-rt=" + self.sdoss_idl_worker_bin]
+        LOG.info("Worker[#%i]: executing --> %s",
+                 self.worker_id, " ".join(idl_cmd))
+        self.process = subprocess.Popen(idl_cmd,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        self.lines = Queue.Queue()
+        reader = threading.Thread(target=self._reader,
+                                  args=(self.process.stdout, self.lines))
+        reader.daemon = True
+        reader.start()
+        self.nprocessed = 0
+
+    def stop(self):
+        if (self.process is None):
+            return
+        if (self.process.poll() is None):
+            try:
+                self._send("QUIT")
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+            if (self._wait(self.ping_timeout)[0] != "EXIT"):
+                self._kill()
+            self.process.wait()
+        LOG.info("Worker[#%i]: stopped after %i fileset(s)",
+                 self.worker_id, self.nprocessed)
+        self.process = None
+
+    def alive(self):
+        return (self.process is not None) and \
+            (self.process.poll() is None)
+
+    def ping(self):
+
+        """Health check: returns True if the worker answers."""
+
+        if not (self.alive()):
+            return False
+        try:
+            self._send("PING")
+        except (IOError, OSError):
+            return False
+        status, output = self._wait(self.ping_timeout)
+        return (status == "PONG")
+
+    def ensure(self):
+
+        """Make sure a healthy worker process is running."""
+
+        if (self.alive()) and (self.nprocessed >= self.recycle):
+            LOG.info("Worker[#%i]: recycling after %i fileset(s)",
+                     self.worker_id, self.nprocessed)
+            self.stop()
+        if (self.ping()):
+            return True
+        if (self.process is not None):
+            LOG.warning("Worker[#%i]: not responding, restarting...",
+                        self.worker_id)
+            self._kill()
+            self.stop()
+        self.start()
+        return self.ping()
+
+    def run(self, idl_args):
+
+        """
+        Process a fileset, providing the sdoss_hfc_processing
+        arguments. Returns the success and the output of the worker.
+        """
+
+        if not (self.ensure()):
+            LOG.error("Worker[#%i]: cannot start %s!",
+                      self.worker_id, self.sdoss_idl_worker_bin)
+            return False, ""
+        try:
+            self._send("\t".join(idl_args))
+        except (IOError, OSError) as e:
+            LOG.error("Worker[#%i]: %s", self.worker_id, str(e))
+            return False, ""
+        status, output = self._wait(self.timeout)
+        self.nprocessed += 1
+        if (status == "TIMEOUT"):
+            LOG.error("Worker[#%i]: no answer after %i sec., killing it!",
+                      self.worker_id, self.timeout)
+            self._kill()
+            self.stop()
+        return (status == "DONE"), "\n".join(output)
+
+
+def history_series(ds):
+
+    """
+    Returns the name of the dataseries ds used in the history,
+    so that nrt, jsoc and vso names of a series share the same key
+    (e.g. hmi.Ic_45s_nrt, hmi__Ic_45s -> hmi.ic_45s).
+    """
+
+    series = ds.lower().replace("__", ".")
+    if (series.endswith("_nrt")):
+        series = series[:-len("_nrt")]
+    return series
+
+
+class sdoss_history:
+
+    """
+    Processing history stored in a sqlite database, with one row
+    per processed record, keyed on (series, T_REC_index).
+
+    If the given file is a former history text file (one processed
+    url per line), its records are imported into a new database,
+    and the text file is kept with a .txt extension.
+
+    The database also keeps, for each dataseries, the watermark of
+    the follow mode, i.e. the last record processed.
+    """
+
+    def __init__(self, history_file, timeout=60.0):
+        self.history_file = history_file
+        self.timeout = timeout
+        if (os.path.isfile(history_file)) and \
+                not (self._is_sqlite(history_file)):
+            self._import_text(history_file)
+        self._create()
+
+    def _is_sqlite(self, filename):
+        with (open(filename, 'rb')) as fr:
+            header = fr.read(16)
+        return (len(header) == 0) or (header == "SQLite format 3\x00")
+
+    def _connect(self):
+        return sqlite3.connect(self.history_file, timeout=self.timeout)
+
+    def _create(self):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS history ("
+                             "series TEXT NOT NULL, "
+                             "t_rec_index INTEGER NOT NULL, "
+                             "t_rec TEXT, fileid TEXT, run_date TEXT, "
+                             "PRIMARY KEY (series, t_rec_index))")
+                conn.execute("CREATE TABLE IF NOT EXISTS watermark ("
+                             "series TEXT PRIMARY KEY, "
+                             "t_rec_index INTEGER NOT NULL, "
+                             "t_rec TEXT, update_date TEXT)")
+        finally:
+            conn.close()
+
+    def _import_text(self, text_file):
+        backup_file = text_file + ".txt"
+        LOG.info("Importing %s into a sqlite history (former file "
+                 "kept as %s)", text_file, backup_file)
+        os.rename(text_file, backup_file)
+        rows = []
+        with (open(backup_file, 'r')) as fr:
+            for url in fr.read().split("\n"):
+                series = re.search(r"series=([^;&]+)", url)
+                record = re.search(r"record=(\d+)", url)
+                if (series is None) or (record is None):
+                    continue
+                rows.append((history_series(series.group(1)),
+                             int(record.group(1)), None, url, None))
+        self._create()
+        self._insert(rows)
+        LOG.info("%i record(s) imported from %s", len(rows), backup_file)
+
+    def _insert(self, rows):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO history "
+                                 "VALUES (?, ?, ?, ?, ?)", rows)
+        finally:
+            conn.close()
+
+    def add(self, ds, t_rec_index, t_rec=None, fileid=None):
+
+        """Add a processed record in the history."""
+
+        if (t_rec is not None):
+            t_rec = t_rec.strftime(INPUT_TFORMAT)
+        run_date = datetime.today().strftime(INPUT_TFORMAT)
+        self._insert([(history_series(ds), int(t_rec_index),
+                       t_rec, fileid, run_date)])
+
+    def processed(self, ds, first_index, last_index):
+
+        """
+        Returns the set of T_REC_index of the records already processed
+        for the dataseries ds between first_index and last_index.
+        """
+
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT t_rec_index FROM history "
+                                "WHERE series = ? AND "
+                                "t_rec_index BETWEEN ? AND ?",
+                                (history_series(ds), int(first_index),
+                                 int(last_index))).fetchall()
+        finally:
+            conn.close()
+        return set([row[0] for row in rows])
+
+    def watermark(self, ds):
+
+        """
+        Returns the (T_REC_index, T_REC) of the last record processed
+        in follow mode for the dataseries ds, or None.
+        """
+
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT t_rec_index, t_rec FROM watermark "
+                               "WHERE series = ?",
+                               (history_series(ds),)).fetchone()
+        finally:
+            conn.close()
+        if (row is None):
+            return None
+        t_rec = row[1]
+        if (t_rec is not None):
+            t_rec = datetime.strptime(t_rec, INPUT_TFORMAT)
+        return row[0], t_rec
+
+    def set_watermark(self, ds, t_rec_index, t_rec):
+
+        """
+        Moves the watermark of the dataseries ds forward to the given
+        record. The watermark is never moved backward.
+        """
+
+        series = history_series(ds)
+        update_date = datetime.today().strftime(INPUT_TFORMAT)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO watermark "
+                             "VALUES (?, ?, NULL, NULL)",
+                             (series, int(t_rec_index)))
+                conn.execute("UPDATE watermark SET t_rec_index = ?, "
+                             "t_rec = ?, update_date = ? "
+                             "WHERE series = ? AND t_rec_index <= ?",
+                             (int(t_rec_index),
+                              t_rec.strftime(INPUT_TFORMAT), update_date,
+                              series, int(t_rec_index)))
+        finally:
+            conn.close()
+
+
+def percentile(values, q):
+
+    """Returns the q-th percentile of values (nearest rank)."""
+
+    values = sorted(values)
+    rank = int(round(q / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+class sdoss_metrics:
+
+    """
+    Stage timing of the sdoss jobs.
+
+    Each job record (see run_sdoss.metrics) is appended to the metrics
+    file as one JSON line, and kept to print a summary of the run:
+    percentiles of the wall-clock time of each stage, and
+    download rate of each data source.
+    """
+
+    # Stages in processing order
+    STAGES = ["exp_request", "exp_status", "ic_download", "m_download",
+              "vso_fallback", "vso_download", "idl", "cleanup"]
+
+    def __init__(self, metrics_file=None):
+        self.metrics_file = metrics_file
+        self.records = []
+
+    def add(self, record):
+
+        """Add a job record and write it in the metrics file."""
+
+        self.records.append(record)
+        if (self.metrics_file is None):
+            return
+        try:
+            with (open(self.metrics_file, 'a')) as fw:
+                fw.write(json.dumps(record, sort_keys=True) + "\n")
+        except IOError as e:
+            LOG.error("Cannot write metrics in %s: %s",
+                      self.metrics_file, str(e))
+
+    def summary(self):
+
+        """
+        Log the stage percentiles, the rate of each data source
+        and the state of the circuit breaker of each host.
+        """
+
+        self.summary_breakers()
+        if (len(self.records) == 0):
+            return
+        LOG.info("Stage timing of %i job(s) (sec.):", len(self.records))
+        LOG.info("%-14s %6s %9s %9s %9s %9s",
+                 "stage", "n", "p50", "p90", "p99", "max")
+        for stage in self.STAGES:
+            times = [record["stages"][stage]["sec"]
+                     for record in self.records
+                     if (stage in record["stages"])]
+            if (len(times) == 0):
+                continue
+            LOG.info("%-14s %6i %9.2f %9.2f %9.2f %9.2f", stage, len(times),
+                     percentile(times, 50), percentile(times, 90),
+                     percentile(times, 99), max(times))
+
+        # Effective download rate (export + transfer) of each source
+        sources = {}
+        for record in self.records:
+            for stage in ["ic_download", "m_download"]:
+                current = record["stages"].get(stage)
+                if (current is None) or \
+                        (current.get("source") in [None, "local", "cache"]):
+                    continue
+                total = sources.setdefault(current["source"], [0, 0, 0.0])
+                total[0] += 1
+                total[1] += current.get("bytes", 0)
+                total[2] += current["sec"]
+        for source in sorted(sources):
+            nfile, nbytes, sec = sources[source]
+            LOG.info("%-14s %6i file(s) %9.1f MB %9.1f sec. %7.2f MB/s",
+                     source, nfile, nbytes / 1.0e6, sec,
+                     nbytes / 1.0e6 / max(sec, 1.0e-6))
+
+    def summary_breakers(self):
+
+        """Log the state of the circuit breaker of each host."""
+
+        states = breaker_states()
+        if (len(states) == 0):
+            return
+        LOG.info("%-22s %9s %8s %6s %8s",
+                 "host", "circuit", "failures", "trips", "rejected")
+        for state in states:
+            LOG.info("%-22s %9s %8i %6i %8i", state["host"], state["state"],
+                     state["failures"], state["trips"], state["rejected"])
+
+
+class data_cache:
+
+    """
+    Cache of the downloaded data files, keyed by dataseries and
+    T_REC_index, in directory/<series>/<T_REC_index>/<filename>.
+    The total size of the cached files is kept under size bytes
+    by removing the least recently used ones, except the files
+    in use by a job, i.e. from get() or put() to release().
+    """
+
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+        self.lock = threading.Lock()
+        # key directory -> [path, bytes, last use]
+        self.entries = {}
+        self.paths = {}
+        self.pins = {}
+        self.total = 0
+        self._scan()
+
+    def _scan(self):
+        if not (os.path.isdir(self.directory)):
+            os.makedirs(self.directory)
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if (filename.endswith(".part")):
+                    continue
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                self._add(dirpath, path, stat.st_size, stat.st_mtime)
+        LOG.info("%i file(s) (%.1f MB) in cache %s", len(self.entries),
+                 self.total / 1.0e6, self.directory)
+
+    def _key(self, ds, t_rec_index):
+        return os.path.join(self.directory, history_series(ds),
+                            str(int(t_rec_index)))
+
+    def _add(self, key, path, nbytes, used):
+        if (key in self.entries) and (self.entries[key][0] == path):
+            self.total -= self.entries.pop(key)[1]
+        elif (key in self.entries):
+            self._remove(key)
+        self.entries[key] = [path, nbytes, used]
+        self.paths[path] = key
+        self.total += nbytes
+
+    def _remove(self, key):
+        path, nbytes, used = self.entries.pop(key)
+        self.paths.pop(path, None)
+        self.total -= nbytes
+        try:
+            os.remove(path)
+            os.rmdir(key)
+        except OSError:
+            pass
+
+    def _evict(self):
+        if (self.total <= self.size):
+            return
+        unpinned = [(entry[2], key) for key, entry in self.entries.items()
+                    if (self.pins.get(entry[0], 0) == 0)]
+        for used, key in sorted(unpinned):
+            if (self.total <= self.size):
+                break
+            LOG.info("%s removed from cache", self.entries[key][0])
+            self._remove(key)
+
+    def get(self, ds, t_rec_index):
+
+        """
+        Returns the cached file of the record t_rec_index of the
+        dataseries ds, or None. The file is kept until release().
+        """
+
+        if (t_rec_index is None):
+            return None
+        key = self._key(ds, t_rec_index)
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is None):
+                return None
+            if not (os.path.isfile(entry[0])):
+                self._remove(key)
+                return None
+            entry[2] = time.time()
+            self.pins[entry[0]] = self.pins.get(entry[0], 0) + 1
+        try:
+            os.utime(entry[0], None)
+        except OSError:
+            pass
+        return entry[0]
+
+    def put(self, ds, t_rec_index, filename):
+
+        """
+        Moves the downloaded filename into the cache, and returns
+        its new path. The file is kept until release().
+        """
+
+        if (t_rec_index is None):
+            return filename
+        key = self._key(ds, t_rec_index)
+        path = os.path.join(key, os.path.basename(filename))
+        with self.lock:
+            try:
+                if not (os.path.isdir(key)):
+                    os.makedirs(key)
+                shutil.move(filename, path)
+            except (IOError, OSError) as e:
+                LOG.error("Cannot move %s into cache: %s", filename, str(e))
+                return filename
+            self._add(key, path, os.path.getsize(path), time.time())
+            self.pins[path] = self.pins.get(path, 0) + 1
+            self._evict()
+        return path
+
+    def release(self, path):
+
+        """
+        Releases a file returned by get() or put(). Returns False if
+        the file is not in the cache.
+        """
+
+        with self.lock:
+            if (path not in self.paths):
+                return False
+            self.pins[path] = self.pins.get(path, 1) - 1
+            if (self.pins[path] <= 0):
+                del self.pins[path]
+            self._evict()
+        return True
@@ -17,7 +17,10 @@ global HOSTNAME, IDL_EXE_PATH, \
     INPUT_TFORMAT, JSOC_TFORMAT, FILE_TFORMAT, \
     COMP_TFORMAT, STARTTIME, ENDTIME, \
     CADENCE, OUTPUT_DIRECTORY, DATA_DIRECTORY, \
-    SDOSS_IDL_BIN, PJOBS, HISTORY_FILE, \
+    SDOSS_IDL_BIN, SDOSS_IDL_WORKER_BIN, WORKER_RECYCLE, IDL_TIMEOUT, \
+    PJOBS, DJOBS, PREFETCH, BATCH_SIZE, HISTORY_FILE, POLL_INTERVAL, \
+    METRICS_FILE, EXPORT_CHUNK, EXPORT_TIMEOUT, JSOC_COMPRESS, CACHE_SIZE, \
+    LATENCY_BUDGET, INFO_CACHE, \
     LOGGER, FTP_URL, LOG, TRACKFIELDS
 
 
@@ -59,7 +62,32 @@ CADENCE = 45
 OUTPUT_DIRECTORY = os.path.join(CURRENT_PATH, "../products")
 DATA_DIRECTORY = os.path.join(CURRENT_PATH, "../data")
 SDOSS_IDL_BIN = os.path.join(CURRENT_PATH, "../bin/sdoss_hfc_processing.sav")
+SDOSS_IDL_WORKER_BIN = os.path.join(CURRENT_PATH, "../bin/sdoss_hfc_worker.sav")
+# Number of filesets processed by a resident idl worker before restarting it
+WORKER_RECYCLE = 50
+# Max. duration in sec. of the processing of one fileset by an idl worker
+IDL_TIMEOUT = 3600
 PJOBS = 1
+# Number of download threads and of filesets downloaded in advance
+DJOBS = 2
+PREFETCH = 2
+# Number of filesets processed by a single idl run
+BATCH_SIZE = 1
+# Time in sec. between two queries of new records in follow mode
+POLL_INTERVAL = 300
+# Number of records exported by a single jsoc request (0 for one per record)
+EXPORT_CHUNK = 50
+# Max. duration in sec. of a jsoc export
+EXPORT_TIMEOUT = 600
+# Compression of the fits files exported by jsoc (None or "rice").
+# Rice compressed files are always staged by jsoc, which delays the
+# quick exports of the online records.
+JSOC_COMPRESS = None
+# Max. size in GB of the data cache in DATA_DIRECTORY/cache (0 for no cache)
+CACHE_SIZE = 20.0
+# Time in sec. given to a mirror (jsoc or vso) to start sending a file
+# before trying the next one as well (0 for sequential fallback)
+LATENCY_BUDGET = 30.0
 
 TRACKFIELDS = ["ID_SUNSPOT", "TRACK_ID", "DATE_OBS",
                "FEAT_X_PIX", "FEAT_Y_PIX",
@@ -73,6 +101,15 @@ HISTORY_FILE = os.path.join(
     "sdoss_hfc_processing.%s.history" % (
         TODAY.strftime(COMP_TFORMAT)))
 
+# stage timing filename (one JSON record per job)
+METRICS_FILE = os.path.join(
+    OUTPUT_DIRECTORY,
+    "sdoss_hfc_processing.%s.metrics" % (
+        TODAY.strftime(COMP_TFORMAT)))
+
+# cache directory of the jsoc record lists (see jsoclib.show_info_cache)
+INFO_CACHE = os.path.join(OUTPUT_DIRECTORY, "show_info")
+
 # Create logger for sdoss_hfc
 LOGGER = "sdoss_hfc"
 LOG = logging.getLogger(LOGGER)
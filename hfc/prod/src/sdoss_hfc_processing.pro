@@ -2,6 +2,9 @@ pro sdoss_hfc_processing, config_file, fnc, fnm, $
                           data_dir=data_dir, $
                           fnc_url=fnc_url,fnm_url=fnm_url, $
                           output_dir=output_dir, $
+                          args=args, $
+                          manifest=manifest, $
+                          status_file=status_file, $
                           QUICKLOOK=QUICKLOOK,$
                           SNAPSHOT=SNAPSHOT, $
                           VERBOSE=VERBOSE,DEBUG=DEBUG
@@ -35,6 +38,15 @@ pro sdoss_hfc_processing, config_file, fnc, fnm, $
 ;     output_dir    - Directory where the output files will be saved.
 ;     fnc_url       - List of Ic file URLS to be passed into output csv files.
 ;     fnm_url       - List of M file URLS to be passed into output csv files.
+;     args          - Vector of arguments to parse instead of the command line
+;                     arguments (used by sdoss_hfc_worker).
+;     manifest      - File listing the filesets to process, one per line, with
+;                     the tab-separated fields: fnc, fnm, fnc_url, fnm_url, date_obs.
+;                     If given, fnc, fnm, fnc_url and fnm_url are read from it.
+;     status_file   - File where the status (DONE, FAILED or ERROR) of each
+;                     fileset is written, one 'index;status' line per fileset.
+;                     In this case, an error on a fileset does not stop
+;                     the processing of the next ones.
 ;
 ; KEYWORD PARAMETERS:
 ;     /DEBUG         - Debug mode.
@@ -75,25 +87,36 @@ Version='1.06'
 ;                               sdoss_hfc_processing routine is now splitted
 ;                               into two separated routines sdoss_hfc_processing
 ;                               and sdoss_processing.
+;     18-OCT-2026:              Added args optional input, so that
+;                               sdoss_hfc_worker can call the routine
+;                               with the arguments of each request.
+;     18-OCT-2026:              Added manifest and status_file optional
+;                               inputs, to process several filesets in
+;                               one idl run.
 ;
 ;-
 
 quote=string(39b)
+tab=string(9b)
 sep=path_sep()
 outfnroot = 'sdoss_'+strjoin(strsplit(version,'.',/EXTRACT))
 
 ;[1];Initializing program
 ;[1]:====================
 
-args = strtrim(command_line_args(),2)
+if (n_elements(args) eq 0) then args = command_line_args()
+args = strtrim(args,2)
 
 nargs = n_elements(args)
 if (nargs gt 2) then begin
    config_file = args[0]
-   fnc = args[1]
-   fnm = args[2]
+   if (strlowcase(strmid(args[1],0,9)) ne 'manifest=') then begin
+      fnc = args[1]
+      fnm = args[2]
+   endif
    inputpar = ['data_dir','output_dir', $
-                'fnc_url','fnm_url']
+                'fnc_url','fnm_url', $
+                'manifest','status_file']
    inputkey = ['/quicklook', '/snapshot', $
                '/debug','/verbose']
    for i=0l,n_elements(args)-1 do begin
@@ -117,11 +140,31 @@ if (nargs gt 2) then begin
    set_plot,'NULL'
 endif 
 
+if (keyword_set(manifest)) then begin
+   if not (file_test(manifest)) then message,manifest+' does not exist!'
+   nset = file_lines(manifest)
+   lines = strarr(nset)
+   openr,lun,manifest,/GET_LUN
+   readf,lun,lines
+   close,lun
+   free_lun,lun
+   fnc = strarr(nset) & fnm = strarr(nset)
+   fnc_url = strarr(nset) & fnm_url = strarr(nset)
+   for i=0l,nset-1l do begin
+      items = strsplit(lines[i],tab,/EXTRACT,/PRESERVE_NULL)
+      fnc[i] = items[0] & fnm[i] = items[1]
+      if (n_elements(items) gt 3) then begin
+         fnc_url[i] = items[2] & fnm_url[i] = items[3]
+      endif
+   endfor
+endif
+
 if (keyword_set(fnc)+keyword_set(fnm)+keyword_set(config_file) ne 3) then begin
     message,/INFO,'Call is:'
     print,'sdoss_hfc_processing, config_file, fnc, fnm, $'
     print,'                      output_dir=output_dir, data_dir=data_dir,$'
     print,'                      fnc_url=fnc_url, fnm_url=fnm_url, $'
+    print,'                      manifest=manifest, status_file=status_file, $'
     print,'                      /QUICKLOOK,/SNAPSHOT, $'
     print,'                      /DEBUG, /VERBOSE'
     return
@@ -130,6 +173,7 @@ DEBUG = keyword_set(DEBUG)
 VERBOSE = keyword_set(VERBOSE)
 QLK = keyword_set(QUICKLOOK)
 SNP = keyword_set(SNAPSHOT)
+BATCH = keyword_set(status_file)
 
 meta_dir=getenv('SDOSS_HFC_DIR')
 
@@ -184,9 +228,19 @@ if (VERBOSE) then print,oby_file+' copied in '+output_dir
 ;[3]:========================
 if not (keyword_set(fnc_url)) then fnc_url=strarr(nfnc)
 if not (keyword_set(fnm_url)) then fnm_url=strarr(nfnc)
+if (BATCH) then openw,slun,status_file,/GET_LUN
 for i=0l,nfnc-1l do begin
 
     ii=strtrim(nfnc-i,2)
+
+    catch,error_status
+    if (error_status ne 0) then begin
+       catch,/CANCEL
+       if not (BATCH) then message,!ERROR_STATE.MSG
+       message,/CONT,'ERROR - ['+fnc[i]+'/'+fnm[i]+'] data set: '+!ERROR_STATE.MSG
+       printf,slun,strtrim(i,2)+';ERROR' & flush,slun
+       continue
+    endif
     fnc_i=fnc[i] & fnm_i=fnm[i]
     if (VERBOSE) then print,'[#'+ii+']: Processing ['+fnc_i+'/'+fnm_i+'] data set...'
 
@@ -227,6 +281,9 @@ for i=0l,nfnc-1l do begin
 
     if (nobs eq 0) then begin
         if (VERBOSE) then message,/CONT,'WARNING - ['+fnc_i+'/'+fnm_i+'] data set has not been processed correctly!'
+        if (BATCH) then begin
+           printf,slun,strtrim(i,2)+';FAILED' & flush,slun
+        endif
         continue
     endif
   
@@ -241,6 +298,9 @@ for i=0l,nfnc-1l do begin
 
    if (nfeat eq 0) then begin
       if (VERBOSE) then print,'No sunspot detected for ['+fnc_i+'/'+fnm_i+'] data set.'
+      if (BATCH) then begin
+         printf,slun,strtrim(i,2)+';DONE' & flush,slun
+      endif
       continue
    endif
    if (VERBOSE) then print,'Writing output feature data file...'
@@ -254,7 +314,15 @@ for i=0l,nfnc-1l do begin
 
 
    if (VERBOSE) then print,'[#'+ii+']: Processing ['+fnc_i+'/'+fnm_i+'] data set...done'
+   if (BATCH) then begin
+      printf,slun,strtrim(i,2)+';DONE' & flush,slun
+   endif
 endfor
+catch,/CANCEL
+if (BATCH) then begin
+   close,slun
+   free_lun,slun
+endif
 ;[3]:========================
 
 END
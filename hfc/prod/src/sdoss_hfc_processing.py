@@ -8,21 +8,21 @@ Wrapper to run the sdoss recognition code in the HFC framework.
 
 import os
 import sys
-import threading
 import subprocess
 import urllib2
 import argparse
 from datetime import datetime, timedelta
 import time
+import numpy as np
 
 try:
-    from MyToolkit import setup_logging, download_file
+    from MyToolkit import setup_logging, download_file, uniq
 except:
     sys.exit("Import failed in module sdoss_hfc_processing :\
               \n\tMyToolkit module is required!")
 
 try:
-    from jsoclib import jsoc
+    from jsoclib import jsoc, show_info_cache
 except:
     sys.exit("Import failed in module sdoss_hfc_processing :\
               \n\tjsoclib module is required!")
@@ -31,13 +31,24 @@ except:
 # Import sdoss hfc global variables
 try:
     from sdoss_hfc_globals import HOSTNAME, INPUT_TFORMAT, \
-        TODAY, PJOBS, SDOSS_IDL_BIN, LOG, IDL_EXE_PATH, \
-        STARTTIME, ENDTIME, CADENCE, HISTORY_FILE,\
+        TODAY, PJOBS, DJOBS, PREFETCH, BATCH_SIZE, SDOSS_IDL_BIN, LOG, IDL_EXE_PATH, \
+        SDOSS_IDL_WORKER_BIN, WORKER_RECYCLE, \
+        STARTTIME, ENDTIME, CADENCE, HISTORY_FILE, POLL_INTERVAL, \
+        METRICS_FILE, EXPORT_CHUNK, JSOC_COMPRESS, CACHE_SIZE, LATENCY_BUDGET, \
+        INFO_CACHE, \
         OUTPUT_DIRECTORY, DATA_DIRECTORY, JSOC_URL, VSO_URL, JSOC_TFORMAT
 except:
     sys.exit("Import failed in module sdoss_hfc_processing :\
              \n\tsdoss_hfc_globals module is required!")
 
+try:
+    from sdoss_hfc_classes import sdoss_pipeline, idl_worker, \
+        sdoss_history, sdoss_metrics, concurrency_controller, jsoc_export, \
+        data_cache, mirror_hedge
+except:
+    sys.exit("Import failed in module sdoss_hfc_processing :\
+             \n\tsdoss_hfc_classes module is required!")
+
 __version__ = "1.0"
 #__license__ = ""
 __author__ = "Xavier Bonnin (LESIA, CNRS)"
@@ -50,6 +61,12 @@ VERSION = __version__
 
 LAUNCH_TIME = time.time()
 
+# Origin of the dates converted into seconds
+EPOCH = datetime(1970, 1, 1)
+
+# Dataseries used as key in the processing history
+HISTORY_SERIES = "hmi.Ic_45s"
+
 
 def main():
 
@@ -85,17 +102,87 @@ def main():
                         default=PJOBS, type=int,
                         help="number of parallelized jobs [default="
                         + str(PJOBS) + "]")
+    parser.add_argument('-w', '--download_jobs', nargs='?',
+                        default=DJOBS, type=int,
+                        help="number of parallelized downloads [default="
+                        + str(DJOBS) + "]")
+    parser.add_argument('-p', '--prefetch', nargs='?',
+                        default=PREFETCH, type=int,
+                        help="number of filesets downloaded ahead of the "
+                        "sdoss jobs [default=" + str(PREFETCH) + "]")
+    parser.add_argument('-k', '--batch_size', nargs='?',
+                        default=BATCH_SIZE, type=int,
+                        help="number of filesets processed by a single "
+                        "idl run [default=" + str(BATCH_SIZE) + "]")
+    parser.add_argument('-i', '--sdoss_idl_worker_bin', nargs='?',
+                        default=SDOSS_IDL_WORKER_BIN,
+                        help="sdoss idl worker binary file [default="
+                        + SDOSS_IDL_WORKER_BIN + "]")
+    parser.add_argument('-n', '--recycle', nargs='?',
+                        default=WORKER_RECYCLE, type=int,
+                        help="number of filesets processed by an idl worker "
+                        "before restarting it [default="
+                        + str(WORKER_RECYCLE) + "]")
+    parser.add_argument('-x', '--export_chunk', nargs='?',
+                        default=EXPORT_CHUNK, type=int,
+                        help="number of records exported by a single jsoc "
+                        "request, 0 for one request per record "
+                        "[default=" + str(EXPORT_CHUNK) + "]")
+    parser.add_argument('-z', '--compress', nargs='?',
+                        default=JSOC_COMPRESS, choices=["rice"],
+                        help="compression of the fits files exported by "
+                        "jsoc (rice), which are then always staged "
+                        "[default=" + str(JSOC_COMPRESS) + "]")
+    parser.add_argument('-g', '--cache_size', nargs='?',
+                        default=CACHE_SIZE, type=float,
+                        help="max. size in GB of the cache of downloaded "
+                        "files in data_directory/cache, 0 for no cache "
+                        "[default=" + str(CACHE_SIZE) + "]")
+    parser.add_argument('-L', '--latency_budget', nargs='?',
+                        default=LATENCY_BUDGET, type=float,
+                        help="time in seconds given to the fastest mirror "
+                        "(jsoc or vso) to start sending a file before trying "
+                        "the other one as well, 0 to try vso only after jsoc "
+                        "has failed [default=" + str(LATENCY_BUDGET) + "]")
     parser.add_argument('-h', '--history_file', nargs='?',
                         default=HISTORY_FILE,
                         help="path to the sdoss history file [default=" +
                         HISTORY_FILE + "]")
+    parser.add_argument('-m', '--metrics_file', nargs='?',
+                        default=METRICS_FILE,
+                        help="path to the file of stage timing of the jobs "
+                        "[default=" + METRICS_FILE + "]")
+    parser.add_argument('-u', '--info_cache', nargs='?',
+                        default=INFO_CACHE,
+                        help="directory of the cache of the jsoc record "
+                        "lists, empty for no cache [default=" +
+                        INFO_CACHE + "]")
     parser.add_argument('-l', '--log_file', nargs='?',
                         default=None,
                         help="Log file.")
+    parser.add_argument('-t', '--poll_interval', nargs='?',
+                        default=POLL_INTERVAL, type=int,
+                        help="time in seconds between two queries of new "
+                        "records in follow mode [default="
+                        + str(POLL_INTERVAL) + "]")
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help="run continuously, processing the new nrt "
+                        "records as they appear after the watermark "
+                        "(starttime is used if there is no watermark yet)")
     parser.add_argument('-Q', '--Quicklook', action='store_true',
                         help="save quick-look images")
     parser.add_argument('-R', '--Remove_data', action='store_true',
                         help="remove data files after processing.")
+    parser.add_argument('-C', '--Client_cadence', action='store_true',
+                        help="select the records every cadence seconds "
+                        "on the client side, instead of using "
+                        "the jsoc @cadence filter")
+    parser.add_argument('-W', '--Worker', action='store_true',
+                        help="run sdoss with pjobs resident idl workers")
+    parser.add_argument('-A', '--Adaptive', action='store_true',
+                        help="adapt the numbers of running downloads and "
+                        "idl jobs to the measured throughput and load, "
+                        "pjobs and download_jobs being the maximum")
     parser.add_argument('-V', '--Verbose', action='store_true',
                         help="verbose mode")
 
@@ -106,12 +193,28 @@ def main():
     cadence = Namespace.cadence
     output_directory = Namespace.output_directory
     sdoss_idl_bin = Namespace.sdoss_idl_bin
+    sdoss_idl_worker_bin = Namespace.sdoss_idl_worker_bin
+    recycle = Namespace.recycle
     data_directory = Namespace.data_directory
     pjobs = Namespace.pjobs
+    djobs = Namespace.download_jobs
+    prefetch = Namespace.prefetch
+    batch_size = Namespace.batch_size
+    export_chunk = Namespace.export_chunk
+    compress = Namespace.compress
+    cache_size = Namespace.cache_size
+    latency_budget = Namespace.latency_budget
     history_file = Namespace.history_file
+    metrics_file = Namespace.metrics_file
+    info_cache = Namespace.info_cache
     log_file = Namespace.log_file
     quicklook = Namespace.Quicklook
     remove = Namespace.Remove_data
+    client_cadence = Namespace.Client_cadence
+    poll_interval = Namespace.poll_interval
+    follow = Namespace.follow
+    use_worker = Namespace.Worker
+    adaptive = Namespace.Adaptive
     verbose = Namespace.Verbose
 
     # Setup the logging
@@ -129,51 +232,101 @@ def main():
         print "$SSW_ONTOLOGY environment variable must be defined!"
         sys.exit(1)
 
-    # Get list of HMI Ic T_REC_index and T_REC
-    # to process between starttime and endtime
-    #ds = "hmi.ic_45s"
-    #ic_index, ic_dates = query_jsoc(ds, starttime, endtime, cadence=cadence)
-    ds = "hmi.Ic_45s_nrt"
-    jsocLink = jsoc(ds, realtime=True, starttime=starttime,
-                endtime=endtime, cadence=cadence,
-                verbose=verbose, notify='christian.renie@obspm.fr')
-    info = jsocLink.show_info(key=["T_REC_index", "T_REC"])
-    ic_index=[] ; ic_dates=[]
-    for row in info.split("\n")[1:-1]:
-        if (row):
-            rs = row.split()
-            ic_index.append(rs[0])
-            ic_dates.append(datetime.strptime(rs[1],JSOC_TFORMAT+"_TAI"))
-    if (len(ic_index) == 0):
-        LOG.warning("Empty hmi file set!")
-        sys.exit(1)
+    worker_factory = None
+    if (use_worker):
+        if not (os.path.exists(sdoss_idl_worker_bin)):
+            LOG.error("%s does not exist!", sdoss_idl_worker_bin)
+            sys.exit(1)
+        worker_factory = lambda index: idl_worker(
+            index, sdoss_idl_worker_bin=sdoss_idl_worker_bin,
+            recycle=recycle)
+
+    job_options = {"output_directory": output_directory,
+                   "data_directory": data_directory,
+                   "sdoss_idl_bin": sdoss_idl_bin,
+                   "quicklook": quicklook,
+                   "remove_data": remove,
+                   "verbose": verbose,
+                   "export_chunk": export_chunk,
+                   "compress": compress,
+                   "cadence": cadence,
+                   "cache": None,
+                   "hedge": None}
+    if (cache_size > 0):
+        job_options["cache"] = data_cache(
+            os.path.join(data_directory, "cache"), int(cache_size * 1.0e9))
+    if (latency_budget > 0):
+        job_options["hedge"] = mirror_hedge(latency_budget)
+    if (client_cadence):
+        # Records are not on the jsoc cadence grid
+        job_options["export_chunk"] = 0
+    run_options = {"djobs": djobs, "prefetch": prefetch,
+                   "worker_factory": worker_factory,
+                   "batch_size": batch_size,
+                   "metrics": sdoss_metrics(metrics_file),
+                   "controller": None}
+    if (adaptive):
+        run_options["controller"] = concurrency_controller(
+            djobs_max=djobs, pjobs_max=pjobs)
+
+    history = sdoss_history(history_file)
+    if (info_cache):
+        info_cache = show_info_cache(info_cache, realtime=True,
+                                     verbose=verbose)
     else:
-        LOG.info("%i record(s) returned.", len(ic_index))
+        info_cache = None
+    if (follow):
+        follow_nrt(config_file, history, starttime, cadence, pjobs,
+                   poll_interval=poll_interval,
+                   client_cadence=client_cadence,
+                   job_options=job_options, run_options=run_options,
+                   info_cache=info_cache)
+        sys.exit(0)
 
-    # If not full cadence, extract images every cadence seconds.
-    if (cadence > 45):
-        LOG.info("Process a set of files every %i sec.", cadence)
-    #     # Generage dates vector
-    #     dateList = [starttime]
-    #     while (max(dateList) < endtime):
-    #         dateList.append(max(dateList) + timedelta(seconds=cadence))
-    #     ic_indices = find_closest(ic_dates,dateList,dt_max=45.0)
-
-    #     new_ic_dates = [] ; new_ic_index = []
-    #     for i,current_ind in enumerate(ic_indices):
-    #         if (current_ind == -1): continue
-    #         new_ic_dates.append(ic_dates[current_ind])
-    #         new_ic_index.append(ic_index[current_ind])
-    #     ic_dates = list(new_ic_dates) ; ic_index = list(new_ic_index)
-    #     del new_ic_dates ; del new_ic_index
+    # Get list of HMI Ic T_REC_index and T_REC
+    # to process between starttime and endtime
+    ic_index, ic_dates = select_records(starttime, endtime, cadence,
+                                        client_cadence=client_cadence,
+                                        info_cache=info_cache,
+                                        verbose=verbose)
 
     nfile = len(ic_index)
     if (nfile == 0):
-        LOG.warning("Empty data set!")
-        sys.exit(0)
+        sys.exit(1)
 
     #LOG.info("%i hmi [Ic,M] fileset(s) to process.",nfile)
 
+    sdoss_jobs = build_jobs(ic_index, ic_dates, history, config_file,
+                            **job_options)
+
+    njobs = len(sdoss_jobs)
+    if (njobs == 0):
+        LOG.warning("Empty processing list!")
+        sys.exit(1)
+
+    # Run sdoss processings
+    LOG.info("%i sdoss job(s) to run...", njobs)
+    run_jobs(sdoss_jobs, pjobs, history, **run_options)
+    run_options["metrics"].summary()
+
+    LOG.info("Running %i sdoss jobs...done", njobs)
+    LOG.info("Total elapsed time: %f min.", (time.time() - LAUNCH_TIME) / 60.0)
+
+
+def build_jobs(ic_index, ic_dates, history, config_file,
+               first_id=1, export_chunk=0, cadence=None,
+               compress=JSOC_COMPRESS, **kwargs):
+
+    """
+    Returns the sdoss jobs for the records of ic_index/ic_dates
+    which are not yet in the history.
+    If export_chunk is greater than 0, the Ic (and M) files of
+    export_chunk consecutive records are exported by a single
+    jsoc request, at the given cadence.
+    compress is the compression of the jsoc exported files.
+    Extra keywords are passed to run_sdoss.
+    """
+
     # Generate the vso url of hmi files
     ds = "hmi__Ic_45s"
     ic_url = get_vso_url(ds, ic_index)
@@ -182,79 +335,230 @@ def main():
 
     # Check if data files have been already processed or not from history file.
     # If they are, remove them from the list.
-    if (os.path.isfile(history_file)):
-        iprocessed = check_history(history_file, ic_url)
-        ic_url_tmp = list(ic_url)
-        ic_dates_tmp = list(ic_dates)
-        for i, current_url in enumerate(ic_url_tmp):
-            if (i in iprocessed):
-                LOG.info("fileid: %s - date/time: %s already processed.",
-                         current_url, str(ic_dates_tmp[i]))
-                j = ic_url.index(current_url)
-                ic_url.pop(j)
-                m_url.pop(j)
-                ic_dates.pop(j)
-            else:
-                LOG.info("fileid: %s - date/time: %s not processed.",
-                         current_url, str(ic_dates_tmp[i]))
-        del ic_url_tmp
-        del ic_dates_tmp
+    iprocessed = history.processed(HISTORY_SERIES,
+                                   min(ic_index, key=int),
+                                   max(ic_index, key=int))
+    ic_todo = []
+    for i, current_url in enumerate(ic_url):
+        if (int(ic_index[i]) in iprocessed):
+            LOG.info("fileid: %s - date/time: %s already processed.",
+                     current_url, str(ic_dates[i]))
+        else:
+            LOG.info("fileid: %s - date/time: %s not processed.",
+                     current_url, str(ic_dates[i]))
+            ic_todo.append(i)
+
+    # Share the jsoc exports between the records of each chunk
+    exports = {}
+    if (export_chunk > 0):
+        if (cadence <= 45):
+            cadence = None
+        for k in range(0, len(ic_todo), export_chunk):
+            chunk = ic_todo[k:k + export_chunk]
+            first = min([ic_dates[i] for i in chunk])
+            last = max([ic_dates[i] for i in chunk])
+            chunk_exports = [jsoc_export(ds, first, last, cadence=cadence,
+                                         notify='christian.renie@obspm.fr',
+                                         compress=compress)
+                             for ds in ["hmi.Ic_45s_nrt", "hmi.M_45s_nrt"]]
+            for i in chunk:
+                exports[i] = chunk_exports
 
     #Initialize sdoss jobs for the unprocessed files
     sdoss_jobs = []
-    for i, current_url in enumerate(ic_url):
+    for k, i in enumerate(ic_todo):
         #LOG.info("Initializing job [#%i] for date/time %s", i, str(ic_dates[i]))
         sdoss_jobs.append(run_sdoss(
-                          i + 1, [current_url, m_url[i]],
+                          k + first_id, [ic_url[i], m_url[i]],
                           config_file,
                           date_obs=[ic_dates[i], ic_dates[i]],
-                          output_directory=output_directory,
-                          data_directory=data_directory,
-                          sdoss_idl_bin=sdoss_idl_bin,
-                          quicklook=quicklook,
-                          remove_data=remove,
-                          verbose=verbose))
+                          t_rec_index=ic_index[i],
+                          exports=exports.get(i),
+                          compress=compress,
+                          **kwargs))
 
-    njobs = len(sdoss_jobs)
-    if (njobs == 0):
-        LOG.warning("Empty processing list!")
-        sys.exit(1)
+    return sdoss_jobs
 
-    # Run sdoss processings
-    LOG.info("%i sdoss job(s) to run...", njobs)
-    running = []
-    npending = njobs
+
+def follow_nrt(config_file, history, starttime, cadence, pjobs,
+               poll_interval=POLL_INTERVAL, client_cadence=False,
+               job_options={}, run_options={}, info_cache=None):
+
+    """
+    Follow mode: polls the nrt dataseries every poll_interval seconds
+    for the records after the watermark stored in the history,
+    and processes them as they appear.
+    The watermark is moved to the last record processed at each poll,
+    so that a poll only queries the new records.
+    If there is no watermark yet, records are queried from starttime.
+    Records which failed are queried again at the next poll, as long
+    as no later record has been processed.
+    The show_info_cache info_cache is only used to catch up records
+    older than its recent period, since it always requests the recent
+    chunks in full.
+    """
+
+    verbose = job_options.get("verbose", False)
+    njobs = 0
+    while (True):
+        watermark = history.watermark(HISTORY_SERIES)
+        if (watermark is None):
+            next_time = starttime
+        else:
+            next_time = watermark[1] + timedelta(seconds=cadence)
+        endtime = datetime.utcnow()
+        if (next_time <= endtime):
+            LOG.info("Polling new records between %s and %s",
+                     str(next_time), str(endtime))
+            poll_cache = info_cache
+            if (info_cache is not None) and \
+                    (total_sec(endtime - next_time) <= info_cache.recent):
+                poll_cache = None
+            try:
+                ic_index, ic_dates = select_records(
+                    next_time, endtime, cadence,
+                    client_cadence=client_cadence, info_cache=poll_cache,
+                    verbose=verbose)
+            except Exception as e:
+                LOG.error("Cannot query new records: %s", str(e))
+                ic_index = []
+
+            if (len(ic_index) > 0):
+                sdoss_jobs = build_jobs(ic_index, ic_dates, history,
+                                        config_file, first_id=njobs + 1,
+                                        **job_options)
+                if (len(sdoss_jobs) > 0):
+                    LOG.info("%i sdoss job(s) to run...", len(sdoss_jobs))
+                    njobs += len(sdoss_jobs)
+                    run_jobs(sdoss_jobs, pjobs, history, **run_options)
+                    if (run_options.get("metrics") is not None):
+                        run_options["metrics"].summary()
+
+                # Move the watermark to the last record processed
+                iprocessed = history.processed(HISTORY_SERIES,
+                                               min(ic_index, key=int),
+                                               max(ic_index, key=int))
+                done = [i for i in range(len(ic_index))
+                        if (int(ic_index[i]) in iprocessed)]
+                if (len(done) > 0):
+                    last = max(done, key=lambda i: int(ic_index[i]))
+                    history.set_watermark(HISTORY_SERIES, ic_index[last],
+                                          ic_dates[last])
+                    LOG.info("Watermark moved to %s (T_REC_index=%s)",
+                             str(ic_dates[last]), ic_index[last])
+
+        time.sleep(poll_interval)
+
+
+def run_jobs(sdoss_jobs, pjobs, history,
+             djobs=DJOBS, prefetch=PREFETCH,
+             worker_factory=None, batch_size=BATCH_SIZE,
+             metrics=None, controller=None):
+
+    """
+    Run the sdoss jobs through a download/idl pipeline,
+    with at most djobs downloads and pjobs idl runs
+    at the same time, and up to prefetch filesets
+    waiting on disk for an idl slot.
+    If worker_factory is given, idl runs are dispatched
+    to resident idl workers instead of new idl processes.
+    If batch_size is greater than 1, up to batch_size
+    ready filesets are processed by a single idl run.
+    The history is updated for every successful job,
+    and the stage timing of every job is added to metrics if given.
+    If a concurrency controller is given, djobs and pjobs are
+    the maximum numbers of running downloads and idl runs.
+    """
+
+    LOG.info("Starting %i download and %i idl thread(s) "
+             "(prefetch=%i)", djobs, pjobs, prefetch)
+    pipeline = sdoss_pipeline(pjobs=pjobs, djobs=djobs, prefetch=prefetch,
+                              worker_factory=worker_factory,
+                              batch_size=batch_size, batch_runner=run_batch,
+                              controller=controller)
+    for current_job in pipeline.run(sdoss_jobs):
+        if (metrics is not None):
+            metrics.add(current_job.metrics())
+        if (current_job.success):
+            history.add(HISTORY_SERIES, current_job.t_rec_index,
+                        t_rec=current_job.date_obs[0],
+                        fileid=current_job.fileid[0])
+            LOG.info("Sdoss Job [#%i] has terminated correctly "
+                     "for date/time %s. (%s)",
+                     current_job.thread_id, str(current_job.date_obs[0]),
+                     str(datetime.today()))
+        else:
+            LOG.error("Sdoss Job [#%i] has failed for date/time %s! (%s)",
+                      current_job.thread_id, str(current_job.date_obs[0]),
+                      str(datetime.today()))
+
+
+def run_batch(sdoss_jobs, worker=None):
+
+    """
+    Run sdoss on several downloaded filesets in a single idl run.
+    The filesets are passed in a manifest file, and the success
+    of each job is read from the status file written by
+    sdoss_hfc_processing.
+    """
+
+    first_job = sdoss_jobs[0]
+    manifest = os.path.join(first_job.data_directory,
+                            "sdoss_hfc_batch.%i.%i.manifest" % (
+                                os.getpid(), first_job.thread_id))
+    status_file = manifest + ".status"
+    with (open(manifest, 'w')) as fw:
+        for current_job in sdoss_jobs:
+            date_obs = current_job.date_obs[0]
+            if (date_obs is not None):
+                date_obs = date_obs.strftime(INPUT_TFORMAT)
+            fields = list(current_job.fileset) + \
+                [url or "" for url in current_job.urls] + [date_obs or ""]
+            fw.write("\t".join(fields) + "\n")
+
+    LOG.info("Running job(s) [#%s] in a single idl run",
+             ",".join([str(current_job.thread_id)
+                       for current_job in sdoss_jobs]))
+    idl_args = [first_job.config_file,
+                "manifest=" + manifest,
+                "status_file=" + status_file] + \
+        first_job.idl_options() + first_job.idl_flags()
+    t0 = time.time()
+    first_job.execute(idl_args, worker=worker, check_errors=False)
+    # The idl run time is shared between the jobs of the batch
+    elapsed = (time.time() - t0) / len(sdoss_jobs)
     for current_job in sdoss_jobs:
-        if (len(running) < pjobs):
-            current_job.start()
-            running.append(current_job)
-            npending -= 1
-            LOG.info("Job [#%i] has started. (%s)",
-                     current_job.thread_id, str(datetime.today()))
-            LOG.info("Current running/pending job(s): %i/%i",
-                     len(running), npending)
-            time.sleep(3)
-
-        i = 0
-        while(len(running) >= pjobs):
-            if (running[i].terminated):
-                if (running[i].success):
-                    with (open(history_file, 'a')) as fw:
-                        fw.write(running[i].fileid[0] + "\n")
-                    LOG.info("Sdoss Job [#%i] has \
-                             terminated correctly for date/time %s. (%s)",
-                             running[i].thread_id, str(running[i].date_obs[0]),
-                             str(datetime.today()))
-                else:
-                    LOG.error("Sdoss Job [#%i] has \
-                              failed for date/time %s! (%s)",
-                              running[i].thread_id, str(running[i].date_obs[0]),
-                              str(datetime.today()))
-                running.remove(running[i])
-            i = (i + 1) % pjobs
+        current_job.add_stage("idl", elapsed)
 
-    LOG.info("Running %i sdoss jobs...done", njobs)
-    LOG.info("Total elapsed time: %f min.", (time.time() - LAUNCH_TIME) / 60.0)
+    status = read_status(status_file)
+    os.remove(manifest)
+
+    for i, current_job in enumerate(sdoss_jobs):
+        current_job.success = (status.get(i) == "DONE")
+        if not (current_job.success):
+            LOG.error("Job[#%i]: status of the fileset in the batch is %s",
+                      current_job.thread_id, status.get(i, "MISSING"))
+
+
+def read_status(status_file):
+
+    """
+    Returns the status (DONE, FAILED or ERROR) of each fileset
+    written by sdoss_hfc_processing in status_file, as a dictionary
+    fileset index -> status. The status file is removed.
+    """
+
+    status = {}
+    if (os.path.isfile(status_file)):
+        with (open(status_file, 'r')) as fr:
+            for row in fr.read().split("\n"):
+                if (row):
+                    rs = row.split(";")
+                    status[int(rs[0])] = rs[1].strip()
+        os.remove(status_file)
+    else:
+        LOG.error("%s has not been written!", status_file)
+    return status
 
 
 def total_sec(td):
@@ -301,26 +605,150 @@ def query_jsoc(ds, starttime, endtime, cadence=None):
 
     return T_REC_index, T_REC
 
-# Module to find in a first list of dates, the ones that are
-# closest to the dates provided in a second reference list.
-# Module returns the subscripts of closest dates of the first list.
-def find_closest(input_datetime,ref_datetime,dt_max=-1):
+def select_records(starttime, endtime, cadence,
+                   client_cadence=False, info_cache=None, verbose=False):
+
+    """
+    Returns the lists of T_REC_index and T_REC of the HMI Ic records
+    to process between starttime and endtime.
+    If client_cadence is True, all the records are requested and
+    the closest ones to each cadence step are selected here,
+    instead of using the @cadence filter of jsoc.
+    The record lists are read from the show_info_cache info_cache
+    if given, which only requests the recent or missing days.
+    """
+
+    #ds = "hmi.ic_45s"
+    #ic_index, ic_dates = query_jsoc(ds, starttime, endtime, cadence=cadence)
+    ds = "hmi.Ic_45s_nrt"
+    if (info_cache is not None):
+        ic_index, ic_trec = info_cache.records(
+            ds, starttime, endtime,
+            cadence=(None if client_cadence else cadence))
+    else:
+        jsocLink = jsoc(ds, realtime=True, starttime=starttime,
+                    endtime=endtime,
+                    cadence=(None if client_cadence else cadence),
+                    verbose=verbose, notify='christian.renie@obspm.fr')
+        info = jsocLink.show_info(key=["T_REC_index", "T_REC"])
+        ic_index=[] ; ic_trec=[]
+        for row in info.split("\n")[1:-1]:
+            if (row):
+                rs = row.split()
+                ic_index.append(rs[0])
+                ic_trec.append(rs[1])
+    if (len(ic_index) == 0):
+        LOG.warning("Empty hmi file set!")
+        return [], []
+    else:
+        LOG.info("%i record(s) returned.", len(ic_index))
+
+    # If not full cadence, extract images every cadence seconds.
+    if (cadence > 45):
+        LOG.info("Process a set of files every %i sec.", cadence)
+        if (client_cadence):
+            # Generate dates vector
+            ref_sec = np.arange(to_seconds([starttime])[0],
+                                to_seconds([endtime])[0] + 1,
+                                cadence, dtype=np.int64)
+            ic_indices = find_closest(trec_to_seconds(ic_trec), ref_sec,
+                                      dt_max=45.0)
+            ic_indices = uniq([i for i in ic_indices if (i != -1)])
+            ic_index = [ic_index[i] for i in ic_indices]
+            ic_trec = [ic_trec[i] for i in ic_indices]
+            LOG.info("%i record(s) selected.", len(ic_index))
+
+    ic_dates = [datetime.strptime(t_rec, JSOC_TFORMAT+"_TAI")
+                for t_rec in ic_trec]
+    return ic_index, ic_dates
+
+
+def to_seconds(dates):
+
+    """
+    Converts a list of datetime into an array of int64 seconds
+    since 1970-01-01.
+    """
+
+    return np.array([total_sec(current_date - EPOCH)
+                     for current_date in dates], dtype=np.int64)
+
+
+def trec_to_seconds(t_rec):
+
+    """
+    Converts a list of T_REC strings (YYYY.MM.DD_hh:mm:ss[_TAI])
+    into an array of int64 seconds since 1970-01-01,
+    without parsing each of them.
+    """
+
+    digits = np.array(t_rec, dtype='S19').view(np.uint8)
+    digits = digits.reshape(-1, 19).astype(np.int64) - ord('0')
+
+    def field(first, width):
+        weights = 10 ** np.arange(width - 1, -1, -1)
+        return np.dot(digits[:, first:first + width], weights)
+
+    months = (field(0, 4) - 1970) * 12 + field(5, 2) - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]')
+    days = days.astype(np.int64) + field(8, 2) - 1
+    return days * 86400 + field(11, 2) * 3600 + \
+        field(14, 2) * 60 + field(17, 2)
+
+
+def as_seconds(dates):
+
+    """Returns dates (datetime or seconds) as an array of int64 seconds."""
+
+    if (isinstance(dates[0], datetime)):
+        return to_seconds(dates)
+    return np.asarray(dates, dtype=np.int64)
+
+
+def find_closest(input_datetime, ref_datetime, dt_max=-1):
+
+    """
+    Module to find in a first list of dates, the ones that are
+    closest to the dates provided in a second reference list.
+    Module returns the subscripts of closest dates of the first list,
+    or -1 if the closest date is more than dt_max seconds away
+    (no limit if dt_max is negative).
+    Dates can be given as datetime or as int64 seconds.
+    """
 
     if (len(input_datetime) == 0) or \
         (len(ref_datetime) == 0):
         return []
 
-    subscripts = []
-    for ref_date in ref_datetime:
-        dt=[]
-        for in_date in input_datetime:
-            dt.append(abs(total_sec(ref_date - in_date)))
-        if (float(min(dt)) > float(dt_max)):
-            subscripts.append(-1)
-        else:
-            subscripts.append(list(dt).index(min(dt)))
+    input_sec = as_seconds(input_datetime)
+    ref_sec = as_seconds(ref_datetime)
 
-    return subscripts
+    # Search the neighbours of each reference date
+    # in the sorted input dates
+    order = np.argsort(input_sec, kind='mergesort')
+    sorted_sec = input_sec[order]
+    nmax = len(sorted_sec) - 1
+    pos = np.searchsorted(sorted_sec, ref_sec)
+    left = np.clip(pos - 1, 0, nmax)
+    right = np.clip(pos, 0, nmax)
+    dt_left = np.abs(ref_sec - sorted_sec[left])
+    dt_right = np.abs(sorted_sec[right] - ref_sec)
+    closest = np.where(dt_right < dt_left, right, left)
+    dt = np.minimum(dt_left, dt_right)
+
+    subscripts = order[closest]
+    if (dt_max >= 0):
+        subscripts[dt > dt_max] = -1
+
+    return subscripts.tolist()
+
+def file_size(filename):
+
+    """Returns the size in bytes of filename, or 0 if it does not exist."""
+
+    if (filename) and (os.path.isfile(filename)):
+        return os.path.getsize(filename)
+    return 0
 
 # Module to generate the url of data set in vso server.
 def get_vso_url(ds,t_rec_index,rice=True):
@@ -337,27 +765,10 @@ def get_vso_url(ds,t_rec_index,rice=True):
 
     return urlList
 
-def check_history(history_file,urlList):
-
-    if not (os.path.isfile(history_file)):
-        LOG.warning("history file "+history_file+" does not exist!")
-        return []
-
-    # Read checklist file
-    fr = open(history_file,'r')
-    fileList = fr.read().split("\n")
-    fr.close()
-
-    indices = []
-    for i,current_url in enumerate(urlList):
-        if (current_url in fileList):
-            indices.append(i)
-
-    return indices
-
-
-# Class to run sdoss (using threading class functionality)
-class run_sdoss(threading.Thread):
+# Class to run sdoss on a fileset.
+# The download() and run() stages are called by the
+# download and idl threads of a sdoss_pipeline.
+class run_sdoss:
 
     def __init__(self,thread_id,fileset,config_file,
                 date_obs=[None,None],
@@ -367,17 +778,30 @@ class run_sdoss(threading.Thread):
                 remove_data=False,
                 verbose=False,
                 idl_exe_path=IDL_EXE_PATH,
-                sdoss_idl_bin=SDOSS_IDL_BIN):
+                sdoss_idl_bin=SDOSS_IDL_BIN,
+                t_rec_index=None,
+                exports=None,
+                cache=None,
+                hedge=None,
+                compress=JSOC_COMPRESS):
 
-        threading.Thread.__init__(self)
         self.terminated =False
         self.success=False
-        self._stopevent = threading.Event()
 
         self.thread_id = thread_id
         self.fileset = fileset
         self.fileid = ["",""]
+        self.urls = [None,None]
         self.date_obs = date_obs
+        self.t_rec_index = t_rec_index
+        # jsoc exports shared with other jobs, for the Ic and M files
+        self.exports = exports
+        # Cache of the downloaded files shared with other jobs
+        self.cache = cache
+        # Latency history of the mirrors shared with other jobs
+        self.hedge = hedge
+        # Compression of the jsoc exported files (None or "rice")
+        self.compress = compress
         self.config_file = config_file
         self.data_directory = data_directory
         self.output_directory = output_directory
@@ -388,111 +812,271 @@ class run_sdoss(threading.Thread):
         self.idl_exe_path=idl_exe_path
         self.sdoss_idl_bin=sdoss_idl_bin
 
+        # Wall-clock time, bytes and source of each stage
+        self.stages = {}
+
 
     def end(self):
         self.terminated = True
-        if (self.remove_data):
-            if (os.path.isfile(self.fileset[0])):
-                os.remove(self.fileset[0])
-                LOG.info(self.fileset[0]+" deleted.")
-            if (os.path.isfile(self.fileset[1])):
-                os.remove(self.fileset[1])
-                LOG.info(self.fileset[1]+" deleted.")
+        t0 = time.time()
+        for current_file in self.fileset:
+            # Cached files are removed by the cache when it is full
+            if (self.cache is not None) and \
+                    (self.cache.release(current_file)):
+                continue
+            if (self.remove_data) and (os.path.isfile(current_file)):
+                os.remove(current_file)
+                LOG.info(current_file+" deleted.")
+        self.add_stage("cleanup", time.time() - t0)
 
 
-    def stop(self):
-        self._stopevent.set()
+    def add_stage(self, stage, elapsed, nbytes=None, source=None):
 
+        """Add elapsed seconds (and bytes) to the given stage."""
 
-    def setTerminated(self,terminated):
-        self.terminated = terminated
+        current = self.stages.setdefault(stage, {"sec": 0.0})
+        current["sec"] += elapsed
+        if (nbytes is not None):
+            current["bytes"] = current.get("bytes", 0) + nbytes
+        if (source is not None):
+            current["source"] = source
 
 
-    def run(self):
+    def metrics(self):
 
-#        if not (os.path.exists(self.idl_exe_path)):
-#            LOG.error("Given path of the IDL executable (%s) does not exist!",self.idl_exe_path)
-#            self.end()
-#            return False
+        """Returns the stage timing record of the job."""
 
-        if not (os.path.exists(self.sdoss_idl_bin)):
-            LOG.error("%s does not exist!",self.sdoss_idl_bin)
-            self.end()
-            return False
+        date_obs = self.date_obs[0]
+        if (date_obs is not None):
+            date_obs = date_obs.strftime(INPUT_TFORMAT)
+        return {"job": self.thread_id,
+                "t_rec_index": self.t_rec_index,
+                "date_obs": date_obs,
+                "success": self.success,
+                "run_date": datetime.today().strftime(INPUT_TFORMAT),
+                "stages": self.stages}
 
-        if (len(self.fileset) != 2):
-            log.error("Input fileset must have two elements!")
-            self.end()
-            return False
 
+    def setTerminated(self,terminated):
+        self.terminated = terminated
+
+
+    def fetch(self, i, ds, label):
+
+        """
+        Get the i-th file of the fileset from the data cache if it is
+        there, or else download it (see download_url) into the cache.
+        """
+
+        t0 = time.time()
+        source = "local"
         #If input files are urls then download data files.
-        if (self.fileset[0].startswith("http:")) or \
-            (self.fileset[0].startswith("ftp:")):
-            ic_url = self.fileset[0]
-            self.fileid[0] = ic_url
-            #try to download from jsoc
-            LOG.info("Job[#%i] downloading ic_file from JSOC  %s", self.thread_id, self.date_obs[0])
-#            j_soc = jsoc("hmi.ic_45s", starttime=self.date_obs[0], endtime=self.date_obs[0], verbose=True, notify='christian.renie@obspm.fr')
-            j_soc = jsoc("hmi.Ic_45s_nrt", realtime=True, starttime=self.date_obs[0], endtime=self.date_obs[0], verbose=True, notify='christian.renie@obspm.fr')
-            ic_file=j_soc.get_fits(output_dir=self.data_directory)
-            if (ic_file):
-                LOG.info("Job[#%i]: %s downloaded from JSOC.", self.thread_id, ic_file)
-                self.fileset[0] = ic_file
+        if (self.fileset[i].startswith("http:")) or \
+            (self.fileset[i].startswith("ftp:")):
+            url = self.fileset[i]
+            self.fileid[i] = url
+            self.urls[i] = url
+            target = None
+            if (self.cache is not None):
+                target = self.cache.get(ds, self.t_rec_index)
+                source = "cache"
+            if (target):
+                LOG.info("Job[#%i]: %s found in cache.", self.thread_id, target)
             else:
-                LOG.info("Job[#%i]: Downloading from VSO for %s %s...", self.thread_id, self.date_obs[0], ic_url)
-                ic_file = download_file(ic_url,
-                                    target_directory=self.data_directory,
-                                            timeout=60,wait=30,quiet=False)
-                if (ic_file):
-                    LOG.info("Job[#%i]: %s downloaded from VSO.", self.thread_id, ic_file)
-                    self.fileset[0] = ic_file
+                target, source = self.download_url(i, ds, label, url)
+                if (target) and (self.cache is not None):
+                    target = self.cache.put(ds, self.t_rec_index, target)
+            if (target):
+                self.fileset[i] = target
         else:
-            ic_url = None
-            ic_file = self.fileset[0]
-            self.fileid[0] = ic_file
-        if not (os.path.isfile(ic_file)):
-            LOG.error("Job[#%i]: ic_file %s does not exist!", self.thread_id, ic_file)
-            self.end()
+            target = self.fileset[i]
+            self.fileid[i] = target
+        # ic_file -> ic_download, m_file -> m_download
+        self.add_stage(label.split("_")[0] + "_download", time.time() - t0,
+                       nbytes=file_size(target), source=source)
+        if not (os.path.isfile(target)):
+            LOG.error("Job[#%i]: %s %s does not exist!", self.thread_id, label, target)
             return False
+        return True
 
-        if (self.fileset[1].startswith("http:")) or \
-            (self.fileset[1].startswith("ftp:")):
-            m_url = self.fileset[1]
-            self.fileid[1] = m_url
-            #try to download from jsoc
-            LOG.info("Job[#%i] downloading m_file from JSOC  %s", self.thread_id, self.date_obs[0])
-#            j_soc = jsoc("hmi.m_45s", starttime=self.date_obs[0], endtime=self.date_obs[0], verbose=True, notify='christian.renie@obspm.fr')
-            j_soc = jsoc("hmi.M_45s_nrt", realtime=True, starttime=self.date_obs[0], endtime=self.date_obs[0], verbose=True, notify='christian.renie@obspm.fr')
-            m_file=j_soc.get_fits(output_dir=self.data_directory)
-            if (m_file):
-                LOG.info("Job[#%i]: %s downloaded from JSOC.", self.thread_id, m_file)
-                self.fileset[1] = m_file
-            else:
-                LOG.info("Job[#%i]: Downloading from VSO for %s %s...", self.thread_id, self.date_obs[0], m_url)
-                m_file = download_file(m_url,
-                         target_directory=self.data_directory,
-                                     timeout=60,wait=30,quiet=False)
-                if (m_file):
-                    LOG.info("Job[#%i]: %s downloaded from VSO.", self.thread_id, m_file)
-                    self.fileset[1] = m_file
+
+    def download_url(self, i, ds, label, url):
+
+        """
+        Download the i-th file of the fileset from the JSOC dataseries
+        ds or from the VSO url.
+        If the job has a mirror_hedge, the mirror with the lowest latency
+        is tried first, and the other one is launched as well if it is
+        too slow to answer. Otherwise JSOC is tried first then VSO,
+        which is then recorded as a fallback (a failed JSOC download).
+        Returns the downloaded file and its source.
+        """
+
+        if (self.hedge is not None):
+            vso_stage = "vso_download"
         else:
-            m_url = None
-            m_file = self.fileList[1]
-            self.fileid[1] = m_file
-        if not (os.path.isfile(m_file)):
-            LOG.error("Job[#%i]: m_file %s does not exist!", self.thread_id, m_file)
-            self.end()
+            vso_stage = "vso_fallback"
+        mirrors = [("jsoc", lambda cancel, started:
+                    self.download_jsoc(i, ds, label, cancel, started)),
+                   ("vso", lambda cancel, started:
+                    self.download_vso(i, url, cancel, started,
+                                      stage=vso_stage))]
+        if (self.hedge is not None):
+            return self.hedge.fetch(mirrors, job_id=self.thread_id)
+        for source, function in mirrors:
+            target = function(None, None)
+            if (target):
+                return target, source
+        return "", ""
+
+
+    def download_jsoc(self, i, ds, label, cancel=None, started=None):
+
+        """
+        Download the i-th file of the fileset from the JSOC export
+        shared with other jobs, or else from its own JSOC export.
+        """
+
+        target = ""
+        #try to download from the jsoc export shared with other jobs
+        if (self.exports is not None):
+            export_url, filename = self.exports[i].get_url(self.date_obs[i], job=self)
+            if (export_url):
+                LOG.info("Job[#%i] downloading %s from JSOC export %s", self.thread_id, label, export_url)
+                target = download_file(export_url,
+                                       target_directory=self.data_directory,
+                                       filename=filename,
+                                       user='hmiteam', passwd='hmiteam',
+                                       cancel=cancel, started=started)
+        #try to download from jsoc
+        if not (target) and not ((cancel is not None) and (cancel.is_set())):
+            LOG.info("Job[#%i] downloading %s from JSOC  %s", self.thread_id, label, self.date_obs[i])
+            j_soc = jsoc(ds, realtime=True, starttime=self.date_obs[i], endtime=self.date_obs[i], verbose=True, notify='christian.renie@obspm.fr', compress=self.compress)
+            target=j_soc.get_fits(output_dir=self.data_directory,
+                                  cancel=cancel, started=started)
+            self.add_stage("exp_request", j_soc.timing.get("exp_request", 0.0))
+            self.add_stage("exp_status", j_soc.timing.get("exp_status", 0.0))
+        if (target):
+            LOG.info("Job[#%i]: %s downloaded from JSOC.", self.thread_id, target)
+        return target
+
+
+    def download_vso(self, i, url, cancel=None, started=None,
+                     stage="vso_fallback"):
+
+        """
+        Download the i-th file of the fileset from the VSO url,
+        its timing being recorded in the given stage.
+        """
+
+        LOG.info("Job[#%i]: Downloading from VSO for %s %s...", self.thread_id, self.date_obs[i], url)
+        t1 = time.time()
+        target = download_file(url,
+                               target_directory=self.data_directory,
+                               timeout=60,quiet=False,
+                               cancel=cancel, started=started)
+        self.add_stage(stage, time.time() - t1,
+                       nbytes=file_size(target), source="vso")
+        if (target):
+            LOG.info("Job[#%i]: %s downloaded from VSO.", self.thread_id, target)
+        return target
+
+
+    def download(self):
+
+        """Download stage: get the Ic and M files of the fileset."""
+
+        if (len(self.fileset) != 2):
+            LOG.error("Input fileset must have two elements!")
             return False
 
-        idl_args = [self.config_file,
-                    ic_file,m_file,
-                    "data_dir="+self.data_directory,
+#        j_soc = jsoc("hmi.ic_45s", ...) / jsoc("hmi.m_45s", ...)
+        if not (self.fetch(0, "hmi.Ic_45s_nrt", "ic_file")):
+            return False
+        return self.fetch(1, "hmi.M_45s_nrt", "m_file")
+
+
+    def idl_options(self):
+
+        """Returns the sdoss_hfc_processing options of the job."""
+
+        idl_args = ["data_dir="+self.data_directory,
                     "output_dir="+self.output_directory]
-        if (ic_url is not None): idl_args.append("fnc_url="+ic_url)
-        if (m_url is not None): idl_args.append("fnm_url="+m_url)
+        return idl_args
+
+
+    def idl_flags(self):
+
+        """Returns the sdoss_hfc_processing keywords of the job."""
+
+        idl_args = []
         if (self.quicklook): idl_args.append("/QUICKLOOK")
         if (self.verbose): idl_args.append("/VERBOSE")
+        return idl_args
+
+
+    def run(self, worker=None):
+
+        """
+        Idl stage: run sdoss on the downloaded fileset,
+        using the resident idl worker if given.
+        The worker answers once the request has ended, so the
+        status of the fileset is read from a status file.
+        """
+
+#        if not (os.path.exists(self.idl_exe_path)):
+#            LOG.error("Given path of the IDL executable (%s) does not exist!",self.idl_exe_path)
+#            return False
+
+        ic_file, m_file = self.fileset
+        ic_url, m_url = self.urls
+        idl_args = [self.config_file,
+                    ic_file,m_file] + self.idl_options()
+        if (ic_url is not None): idl_args.append("fnc_url="+ic_url)
+        if (m_url is not None): idl_args.append("fnm_url="+m_url)
+        idl_args.extend(self.idl_flags())
+        if (worker is not None):
+            status_file = os.path.join(self.data_directory,
+                                       "sdoss_hfc_worker.%i.%i.status" % (
+                                           os.getpid(), self.thread_id))
+            idl_args.append("status_file=" + status_file)
+
+        t0 = time.time()
+        self.success = self.execute(idl_args, worker=worker)
+        if (worker is not None):
+            status = read_status(status_file).get(0)
+            if (self.success) and (status != "DONE"):
+                LOG.error("Job[#%i]: status of the fileset is %s",
+                          self.thread_id, status or "MISSING")
+                self.success = False
+        self.add_stage("idl", time.time() - t0)
+        return self.success
+
+
+    def execute(self, idl_args, worker=None, check_errors=True):
+
+        """
+        Run sdoss_hfc_processing with the given arguments, on the
+        resident idl worker if given, or else in a new idl process.
+        Returns True if the run has ended without error.
+        If check_errors is False, messages on stderr are
+        not considered as errors.
+        """
+
+        if (worker is not None):
+            LOG.info("Job[#%i]: sending to worker [#%i] --> %s",
+                     self.thread_id, worker.worker_id, " ".join(idl_args))
+            success, output = worker.run(idl_args)
+            if not (success):
+                LOG.error("Error running idl worker [#%i] with %s, output: %s",
+                          worker.worker_id, " ".join(idl_args), output)
+            return success
+
+        if not (os.path.exists(self.sdoss_idl_bin)):
+            LOG.error("%s does not exist!",self.sdoss_idl_bin)
+            return False
 
+        success = False
         #build idl command line
         idl_cmd = [self.idl_exe_path]+["-quiet","-rt="+self.sdoss_idl_bin,"-args"]
         #idl_cmd = [self.idl_exe_path]+["-rt="+self.sdoss_idl_bin,"-args"]
@@ -504,14 +1088,13 @@ class run_sdoss(threading.Thread):
             if idl_process.wait() == 0:
                 #LOG.info("Sucessfully ran idl command %s, output: %s, errors: %s",
                 #       ' '.join(idl_cmd), str(output), str(errors))
-                if (len(errors) == 0): self.success=True
+                if (len(errors) == 0) or not (check_errors): success=True
             else:
                 LOG.error("Error running idl command %s, output: %s, errors: %s",
                        ' '.join(idl_cmd), str(output), str(errors))
         except OSError as e:
             LOG.error(str(e))
-        self.end()
-        time.sleep(3)
+        return success
 
 
 if (__name__ == "__main__"):
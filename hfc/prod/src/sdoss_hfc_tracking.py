@@ -12,11 +12,12 @@ import shutil
 import argparse
 import ftplib
 import glob
+from collections import deque
 import numpy as np
 
 # Import MyToolkit methods
 try:
-    from MyToolkit import indices, setup_logging, \
+    from MyToolkit import setup_logging, \
         read_csv, write_csv, download_file
 except:
     sys.exit("Import failed in module sdoss_hfc_traking :\
@@ -34,7 +35,7 @@ except:
 
 # Import sdoss hfc global variables
 try:
-    from sdoss_tracking import tracking
+    from sdoss_tracking import tracking, online_tracker
 except:
     sys.exit("Import failed in module sdoss_hfc_tracking :\
               \n\tsdoss_tracking module is required!")
@@ -48,6 +49,11 @@ __author__ = "Xavier Bonnin"
 __email__ = "xavier.bonnin@obspm.fr"
 __date__ = "19-JUL-2013"
 
+# Columns read from the sdoss feat files
+FEAT_COLUMNS = ['DATE_OBS', 'FEAT_HG_LONG_DEG', 'FEAT_HG_LAT_DEG',
+                'FEAT_X_PIX', 'FEAT_Y_PIX', 'FEAT_AREA_DEG2',
+                'FEAT_FILENAME']
+
 
 def parse_configfile(configfile):
 
@@ -151,36 +157,98 @@ def get_filelist(starttime, endtime,
     return filelist
 
 
+def read_featfile(current_file, current_date=None):
+
+    """
+    Extract required data from a sdoss feat file, which date of
+    observation is read from its init file if not given.
+    Returns a dictionary of columns, or None if the file is empty.
+    """
+
+    if (current_date is None):
+        current_date = get_date_obs(current_file)
+    current_data = read_csv(current_file)
+    if (len(current_data) == 0):
+        LOG.error("Empty file: %s!", current_file)
+        return None
+    nfeat = len(current_data)
+    return {
+        'DATE_OBS': [current_date] * nfeat,
+        'FEAT_HG_LONG_DEG': [float(cd['FEAT_HG_LONG_DEG'])
+                             for cd in current_data],
+        'FEAT_HG_LAT_DEG': [float(cd['FEAT_HG_LAT_DEG'])
+                            for cd in current_data],
+        'FEAT_X_PIX': [int(cd['FEAT_X_PIX']) for cd in current_data],
+        'FEAT_Y_PIX': [int(cd['FEAT_Y_PIX']) for cd in current_data],
+        'FEAT_AREA_DEG2': [float(cd['FEAT_AREA_DEG2'])
+                           for cd in current_data],
+        'FEAT_FILENAME': [current_file] * nfeat}
+
+
 def read_fileset(fileset):
 
     """
     Extract required data from the sdoss fileset.
     """
 
-    feat_data = {
-        'DATE_OBS': [],
-        'FEAT_HG_LONG_DEG': [],
-        'FEAT_HG_LAT_DEG': [],
-        'FEAT_X_PIX': [],
-        'FEAT_Y_PIX': [],
-        'FEAT_AREA_DEG2': [],
-        'FEAT_FILENAME': []}
+    window = feature_window(len(fileset))
     for current_file in fileset:
-        current_date = get_date_obs(current_file)
-        current_data = read_csv(current_file)
-        if (len(current_data) == 0):
-            LOG.error("Empty file: %s!", current_file)
+        if not (window.push(current_file)):
             return None
-        for cd in current_data:
-            feat_data['DATE_OBS'].append(current_date)
-            feat_data['FEAT_HG_LONG_DEG'].append(float(cd['FEAT_HG_LONG_DEG']))
-            feat_data['FEAT_HG_LAT_DEG'].append(float(cd['FEAT_HG_LAT_DEG']))
-            feat_data['FEAT_X_PIX'].append(int(cd['FEAT_X_PIX']))
-            feat_data['FEAT_Y_PIX'].append(int(cd['FEAT_Y_PIX']))
-            feat_data['FEAT_AREA_DEG2'].append(float(cd['FEAT_AREA_DEG2']))
-            feat_data['FEAT_FILENAME'].append(current_file)
+    return window.feat_data()
+
+
+class feature_window:
+
+    """
+    Features of the last max_files sdoss files, kept as one block of
+    columns (see read_featfile) per file, so that moving the window
+    reads the new file only.
+    """
+
+    def __init__(self, max_files):
+        self.max_files = max_files
+        self.blocks = deque()
 
-    return feat_data
+    def push(self, current_file):
+
+        """
+        Read current_file into the window, dropping the oldest file
+        if the window is full. Returns False if the file is empty.
+        """
+
+        block = read_featfile(current_file)
+        if (block is None):
+            return False
+        self.blocks.append((current_file, block))
+        if (len(self.blocks) > self.max_files):
+            self.blocks.popleft()
+        return True
+
+    def feat_data(self):
+
+        """Returns the columns of the features of the window."""
+
+        feat_data = dict((key, []) for key in FEAT_COLUMNS)
+        for current_file, block in self.blocks:
+            for key in FEAT_COLUMNS:
+                feat_data[key].extend(block[key])
+        return feat_data
+
+    def rows(self, current_file):
+
+        """
+        Returns the indices in feat_data() of the
+        features of current_file.
+        """
+
+        first = 0
+        for block_file, block in self.blocks:
+            nfeat = len(block['FEAT_FILENAME'])
+            if (block_file == current_file):
+                return range(first, first + nfeat)
+            first += nfeat
+        return []
 
 
 def get_trackfile(fileset, target_directory):
@@ -256,6 +324,123 @@ def load_trackid(trackset, feat_data, max_track_id):
 
     return track_id
 
+
+def track_filename(current_file, output_directory):
+
+    """Returns the track file of the sdoss feat file in output_directory."""
+
+    return os.path.join(output_directory,
+                        os.path.basename(current_file).split("_feat.csv")[0]
+                        + "_track.csv")
+
+
+def max_trackid(trackset):
+
+    """
+    Returns the highest track id of the list of track files
+    (0 if there is none).
+    """
+
+    max_tid = 0
+    for current_file in trackset:
+        if not (os.path.isfile(current_file)):
+            continue
+        current_data = read_csv(current_file, quiet=True)
+        if (current_data is None):
+            continue
+        for td in current_data:
+            max_tid = max(max_tid, int(td['TRACK_ID']))
+    return max_tid
+
+def write_trackfile(output_file, current_file, feat_data, ind,
+                    track_id, lvl_trust, history_file=None):
+
+    """
+    Write the track file output_file of the sdoss file current_file,
+    which features are the ind-th ones of feat_data.
+    Returns False if it cannot be saved.
+    """
+
+    output_data = []
+    for k, ci in enumerate(ind):
+        output_data.append({'ID_SUNSPOT': k + 1,
+                            'TRACK_ID': track_id[ci],
+                            'DATE_OBS':
+                            feat_data['DATE_OBS'][ci].strftime(
+                                INPUT_TFORMAT),
+                            'FEAT_X_PIX':
+                            feat_data['FEAT_X_PIX'][ci],
+                            'FEAT_Y_PIX':
+                            feat_data['FEAT_Y_PIX'][ci],
+                            'PHENOM': "", 'REF_FEAT': "",
+                            'LVL_TRUST': int(lvl_trust[ci]),
+                            'FEAT_FILENAME': current_file,
+                            'RUN_DATE': TODAY.strftime(INPUT_TFORMAT)
+                            })
+    if not (write_csv(output_data, output_file,
+                      fieldnames=TRACKFIELDS, overwrite=True)):
+        LOG.error("can not save %s!", output_file)
+        return False
+    LOG.info("%s saved", output_file)
+    if not (history_file is None):
+        hfiles = []
+        if (os.path.isfile(history_file)):
+            with (open(history_file, 'r')) as fr:
+                hfiles = fr.read().split("\n")
+        if not (os.path.basename(output_file) in hfiles):
+            with (open(history_file, 'a')) as fa:
+                fa.write(os.path.basename(output_file) + "\n")
+    return True
+
+
+def track_online(fileset, output_directory, state_file,
+                 radius=5.0, dt_max=86400, area_min=0.0,
+                 history_file=None, restart=False):
+
+    """
+    Track the files of fileset one at a time with an online_tracker,
+    which state is kept in state_file between runs. Files which are
+    not later than the last file of the state are skipped, using the
+    date in their name, so that only the new files are read.
+    Without state file, the track ids start after the ones of the
+    track files already in output_directory (unless restart is set).
+    """
+
+    tracker = online_tracker(radius=radius, dt_max=dt_max,
+                             area_min=area_min)
+    if not (restart):
+        if (os.path.isfile(state_file)):
+            if not (tracker.load(state_file)):
+                sys.exit(1)
+        else:
+            LOG.warning("No state file, reading previous track files...")
+            tracker.max_track_id = max_trackid(
+                [track_filename(current_file, output_directory)
+                 for current_file in fileset])
+
+    for current_file in sorted(fileset, key=extract_date):
+        if (tracker.last_date is not None) and \
+                (extract_date(current_file) <= tracker.last_date):
+            continue
+        current_date = get_date_obs(current_file)
+        feat_data = read_featfile(current_file, current_date=current_date)
+        if (feat_data is None):
+            continue
+        LOG.info("Run online tracking for %s", current_file)
+        track_id, lvl_trust = tracker.update(
+            current_date,
+            feat_data['FEAT_HG_LONG_DEG'],
+            feat_data['FEAT_HG_LAT_DEG'],
+            feat_data['FEAT_AREA_DEG2'])
+        output_file = track_filename(current_file, output_directory)
+        if not (write_trackfile(output_file, current_file, feat_data,
+                                range(len(track_id)), track_id, lvl_trust,
+                                history_file=history_file)):
+            sys.exit(1)
+        tracker.save(state_file)
+    LOG.info("max_track_id %i", tracker.max_track_id)
+
+
 if (__name__ == "__main__"):
     parser = argparse.ArgumentParser(description="sdoss tracking module",
                                      conflict_handler='resolve',
@@ -280,6 +465,12 @@ if (__name__ == "__main__"):
     parser.add_argument('-h', '--history_file', nargs='?',
                         default=None,
                         help="Pathname of the history file")
+    parser.add_argument('-t', '--state_file', nargs='?',
+                        default=None,
+                        help="Pathname of the state file of the online "
+                        "tracking: if given, each new file is tracked "
+                        "once against the tracks active in the state, "
+                        "instead of sliding windows of MAX_FILES files")
     parser.add_argument('-V', '--Verbose', action='store_true',
                         help="Talkative mode")
     parser.add_argument('-R', '--Restart', action='store_true',
@@ -292,6 +483,7 @@ if (__name__ == "__main__"):
     data_directory = args.data_directory
     output_directory = args.output_directory
     history_file = args.history_file
+    state_file = args.state_file
     log_file = args.log_file
     verbose = args.Verbose
     restart = args.Restart
@@ -325,6 +517,12 @@ if (__name__ == "__main__"):
     if (nfile == 0):
         sys.exit()
 
+    if (state_file is not None):
+        track_online(fileset, output_directory, state_file,
+                     radius=radius, dt_max=dt_max, area_min=area_min,
+                     history_file=history_file, restart=restart)
+        sys.exit()
+
     # If they exist, make a copy of track files from previous run
     # into the output directory
     if not (restart):
@@ -335,9 +533,15 @@ if (__name__ == "__main__"):
     if (len(trackset) == 0):
         LOG.warning("No previous track files read!")
 
+    # Each file is read once, when it enters the window
+    window = feature_window(max_files)
     for i in range(nfile - max_files + 1):
         current_fileset = fileset[i:i + max_files]
-        feat_data_i = read_fileset(current_fileset)
+        new_files = current_fileset if (i == 0) else current_fileset[-1:]
+        for current_file in new_files:
+            if not (window.push(current_file)):
+                sys.exit(1)
+        feat_data_i = window.feat_data()
 
         current_trackset = [
             os.path.join(
@@ -364,35 +568,8 @@ if (__name__ == "__main__"):
         max_track_id = np.max([np.max(track_id), max_track_id])
         LOG.info("max_track_id %i", max_track_id)
         for j, current_file in enumerate(current_fileset):
-            ind = indices(feat_data_i['FEAT_FILENAME'], current_file)
-            output_data = []
-            for k, ci in enumerate(ind):
-                output_data.append({'ID_SUNSPOT': k + 1,
-                                    'TRACK_ID': track_id[ci],
-                                    'DATE_OBS':
-                                    feat_data_i['DATE_OBS'][ci].strftime(
-                                        INPUT_TFORMAT),
-                                    'FEAT_X_PIX':
-                                    feat_data_i['FEAT_X_PIX'][ci],
-                                    'FEAT_Y_PIX':
-                                    feat_data_i['FEAT_Y_PIX'][ci],
-                                    'PHENOM': "", 'REF_FEAT': "",
-                                    'LVL_TRUST': int(lvl_trust[ci]),
-                                    'FEAT_FILENAME': current_file,
-                                    'RUN_DATE': TODAY.strftime(INPUT_TFORMAT)
-                                    })
-            output_file = current_trackset[j]
-            if (write_csv(output_data, output_file,
-                          fieldnames=TRACKFIELDS, overwrite=True)):
-                LOG.info("%s saved", output_file)
-                if not (history_file is None):
-                    hfiles = []
-                    if (os.path.isfile(history_file)):
-                        with (open(history_file, 'r')) as fr:
-                            hfiles = fr.read().split("\n")
-                    if not (os.path.basename(output_file) in hfiles):
-                        with (open(history_file, 'a')) as fa:
-                            fa.write(os.path.basename(output_file) + "\n")
-            else:
-                LOG.error("can not save %s!", output_file)
+            ind = window.rows(current_file)
+            if not (write_trackfile(current_trackset[j], current_file,
+                                    feat_data_i, ind, track_id, lvl_trust,
+                                    history_file=history_file)):
                 sys.exit(1)
@@ -0,0 +1,98 @@
+pro sdoss_hfc_worker
+
+;+
+; NAME:
+;     sdoss_hfc_worker
+;
+; PURPOSE:
+;     Resident SDOSS HFC worker.
+;     Reads requests from the standard input, one per line,
+;     and runs sdoss_hfc_processing for each of them, so that
+;     the IDL runtime and the SSW routines are loaded only once
+;     for a series of filesets.
+;
+; CATEGORY:
+;     Image processing
+;
+; GROUP:
+;     SDOSS_HFC
+;
+; CALLING SEQUENCE:
+;     idl -quiet -rt=sdoss_hfc_worker.sav
+;
+; INPUTS:
+;     Requests are read from the standard input:
+;       PING    - The worker answers 'SDOSS_WORKER PONG'.
+;       QUIT    - The worker exits.
+;     Any other line is a list of tab-separated arguments, with the
+;     same syntax as the command line arguments of sdoss_hfc_processing.
+;     The worker answers 'SDOSS_WORKER DONE' when the processing
+;     has ended normally, or 'SDOSS_WORKER ERROR <message>' otherwise.
+;     DONE does not mean that the filesets have been processed: their
+;     status is written in the status_file given in the request.
+;
+; OPTIONAL INPUTS:
+;     None.
+;
+; KEYWORD PARAMETERS:
+;     None.
+;
+; OUTPUTS:
+;     Status lines written on the standard output (see INPUTS).
+;
+; OPTIONAL OUTPUTS:
+;     None.
+;
+; COMMON BLOCKS:
+;     None.
+;
+; SIDE EFFECTS:
+;     None.
+;
+; RESTRICTIONS/COMMENTS:
+;     Status lines are flushed after each request, so the calling program
+;     can wait for them on the worker standard output.
+;
+; CALL:
+;     sdoss_hfc_processing
+;
+; EXAMPLE:
+;     None.
+;
+; MODIFICATION HISTORY:
+;     Written on 18-OCT-2026.
+;
+;-
+
+tab=string(9b)
+set_plot,'NULL'
+
+line=''
+while (~eof(0)) do begin
+   readf,0,line
+   request=strtrim(line,2)
+   if (request eq '') then continue
+
+   if (strupcase(request) eq 'QUIT') then break
+   if (strupcase(request) eq 'PING') then begin
+      print,'SDOSS_WORKER PONG'
+      flush,-1
+      continue
+   endif
+
+   catch,error_status
+   if (error_status ne 0) then begin
+      catch,/CANCEL
+      print,'SDOSS_WORKER ERROR '+!ERROR_STATE.MSG
+      flush,-1
+      message,/RESET
+      continue
+   endif
+   sdoss_hfc_processing,args=strsplit(request,tab,/EXTRACT)
+   catch,/CANCEL
+
+   print,'SDOSS_WORKER DONE'
+   flush,-1
+endwhile
+
+END
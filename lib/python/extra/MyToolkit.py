@@ -9,12 +9,18 @@ X.Bonnin (LESIA, CNRS), 11-JUL-2013
 import os
 import sys
 import urllib2
+import httplib
 import socket
 import time
 import cStringIO
 import csv
 import sqlite3
 
+from hostpool import get_limiter, get_breaker, get_session
+
+# Size in bytes of the chunks written by download_file
+DOWNLOAD_CHUNK = 1048576
+
 def sqlite_get(sqlite_file,cmd):
 
     """Method to query a sqlite db"""
@@ -166,78 +172,218 @@ def write_csv(content,output_file,fieldnames=None,
 def download_file(url,
                   target_directory=".",
                   filename="",
-                  tries=3,wait=3,
+                  tries=3,wait=0,
                   timeout=None,
                   quiet=False,
                   get_stream=False,
                   user=None,
-                  passwd=None):
+                  passwd=None,
+                  session=None,
+                  cancel=None,
+                  started=None):
 
     """
     Method to download a file.
+    The file is written by chunks in a .part file, which is renamed
+    once complete. The .part file left by an interrupted transfer is
+    resumed with a http Range request.
+    Requests are paced by the limiter of the url host (see hostpool),
+    which is shared by all the threads of the process. They are not
+    sent while the circuit breaker of the host is open, which makes
+    the download fail at once.
+    wait is an optional extra delay in seconds between two tries.
+    Connections are kept open in the http session (see hostpool),
+    which is shared by the whole process if not given.
+    cancel is an optional threading.Event stopping the download
+    (the partial file is removed) when it is set, and started an
+    optional object whose set() method is called when the server
+    starts sending the file.
     """
+    if (session is None):
+        session = get_session()
     if user is not None and passwd is not None:
-        passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
-        # this creates a password manager
-        passman.add_password(None, url, user, passwd)
-        # because we have put None at the start it will always
-        # use this username/password combination for  urls
-        # for which `url` is a super-url
-
-        authhandler = urllib2.HTTPBasicAuthHandler(passman)
-        # create the AuthHandler
-
-        opener = urllib2.build_opener(authhandler)
-        urllib2.install_opener(opener)
-	
+        session.set_auth(url, user, passwd)
+
+    limiter = get_limiter(url)
+    breaker = get_breaker(url)
     target = ""
-    for i in range(tries):
-        try:
-            connect = urllib2.urlopen(url,None,timeout)
-        except urllib2.HTTPError as e:
-            print 'The server couldn\'t fulfill the request.'
-            print 'Error code: ', e.code
-            time.sleep(wait)
-            continue
-        except urllib2.URLError,e:
-            if not (quiet): print "Can not reach %s: %s [%s]" % (url,e,tries-i)
-            time.sleep(wait)
-            continue
-        except socket.timeout, e:
-            if not (quiet): print "Timeout %s: %s [%s]" % (url,e,tries-i)
-            time.sleep(wait)
-            continue
-        else:
-            if (get_stream):
-                content = connect.read()
-                return content
-
-            if not (filename):
-                if (connect.info().has_key('Content-Disposition')):
-                    filename = connect.info()['Content-Disposition'].split('filename=')[1]
-                    if (filename.startswith("'")) or (filename.startswith("\"")):
-                        filename=filename[1:-1]
+    headers = None
+    i = -1
+    while (i < tries - 1):
+        i += 1
+        if (i > 0) and (wait > 0): time.sleep(wait)
+        if (cancel is not None) and (cancel.is_set()):
+            if (target) and (os.path.isfile(target+".part")):
+                os.remove(target+".part")
+            target = ""
+            break
+        if not (breaker.allow()):
+            if not (quiet): print "%s is not available, skipping %s" % (breaker.host,url)
+            target = ""
+            break
+        if (filename) and (headers is None) and (url.startswith("http")) and \
+                (os.path.isfile(os.path.join(target_directory,filename)+".part")):
+            offset = os.path.getsize(os.path.join(target_directory,filename)+".part")
+            headers = {"Range": "bytes=%i-" % (offset)}
+        with limiter:
+            try:
+                connect = session.urlopen(url,timeout=timeout,headers=headers)
+            except urllib2.HTTPError as e:
+                print 'The server couldn\'t fulfill the request.'
+                print 'Error code: ', e.code
+                if (e.code >= 500):
+                    breaker.failure()
+                else:
+                    breaker.success()
+                # Range not satisfiable: the partial file is complete
+                # (e.g. interrupted before its renaming) or invalid
+                if (e.code == 416) and (headers is not None):
+                    headers = None
+                    if not (target) and (filename):
+                        target = os.path.join(target_directory,filename)
+                    if (target) and (os.path.isfile(target+".part")):
+                        size = _range_size(e)
+                        if (size is not None) and \
+                                (os.path.getsize(target+".part") == size):
+                            os.rename(target+".part", target)
+                            break
+                        os.remove(target+".part")
+                    # Restart the transfer (not counted as a try)
+                    i -= 1
+                continue
+            except urllib2.URLError,e:
+                breaker.failure()
+                if not (quiet): print "Can not reach %s: %s [%s]" % (url,e,tries-i)
+                continue
+            except socket.timeout, e:
+                breaker.failure()
+                if not (quiet): print "Timeout %s: %s [%s]" % (url,e,tries-i)
+                continue
+            else:
+                # The host is reported as working once the transfer
+                # has ended, as a dying host often accepts connections
+                # then stalls
+                if (get_stream):
+                    try:
+                        content = connect.read()
+                    except (socket.error, httplib.HTTPException), e:
+                        if not (quiet): print "Transfer of %s interrupted: %s [%s]" % (url,e,tries-i)
+                        breaker.failure()
+                        continue
+                    breaker.success()
+                    return content
+                if (started is not None): started.set()
+
+                if not (filename):
+                    if (connect.info().has_key('Content-Disposition')):
+                        filename = connect.info()['Content-Disposition'].split('filename=')[1]
+                        if (filename.startswith("'")) or (filename.startswith("\"")):
+                            filename=filename[1:-1]
+                        else:
+                            filename=os.path.basename(url)
                     else:
                         filename=os.path.basename(url)
-                else:
-                    filename=os.path.basename(url)
-            target=os.path.join(target_directory,filename)
-            if not (os.path.isfile(target)):
+                target=os.path.join(target_directory,filename)
+                if (os.path.isfile(target)):
+                    connect.close()
+                    breaker.success()
+                    if not (quiet): print "%s already exists" % (target)
+                    break
+
+                # Resume the partial file left by an interrupted transfer
+                part = target+".part"
+                offset = 0
+                if (os.path.isfile(part)): offset = os.path.getsize(part)
+                if (offset > 0) and (headers is None) and \
+                        (url.startswith("http")):
+                    # Request the missing bytes (not counted as a try)
+                    connect.close()
+                    breaker.success()
+                    headers = {"Range": "bytes=%i-" % (offset)}
+                    i -= 1
+                    continue
                 try:
-                    fw = open(target,'wb')
-                    fw.write(connect.read())
+                    complete = _write_stream(connect, part, offset, cancel=cancel)
+                # socket.error is an IOError: network errors come first
+                except (socket.error, httplib.HTTPException), e:
+                    if not (quiet): print "Transfer of %s interrupted: %s [%s]" % (url,e,tries-i)
+                    complete = False
                 except IOError as e:
+                    breaker.success()
                     if not (quiet): print "Can not download %s!" % (url)
+                    target = ""
                     break
-                else:
-                    fw.close()
+                if (complete):
+                    breaker.success()
+                    os.rename(part, target)
                     break
-            else:
-                if not (quiet): print "%s already exists" % (target)
-                break
+                if (cancel is not None) and (cancel.is_set()):
+                    breaker.success()
+                    if (os.path.isfile(part)): os.remove(part)
+                    target = ""
+                    break
+                # Interrupted or truncated transfer: next try resumes it
+                breaker.failure()
+                headers = None
+    else:
+        if (target) and not (os.path.isfile(target)): target = ""
     return target
 
 
+def _range_size(error):
+
+    """
+    Returns the full size of the file given by the Content-Range
+    header ("bytes */size") of a 416 error, or None if unknown.
+    """
+
+    content_range = error.info().getheader('Content-Range', '')
+    if not (content_range.startswith("bytes */")):
+        return None
+    try:
+        return int(content_range.split('/')[1])
+    except ValueError:
+        return None
+
+
+def _write_stream(connect, part, offset, cancel=None):
+
+    """
+    Writes the content of the response connect in the file part,
+    by chunks of DOWNLOAD_CHUNK bytes, after the offset first bytes
+    already in the file if the response is a partial content.
+    Returns True if the whole content has been received (checked
+    against Content-Length when it is given), the file being
+    written on disk. The transfer stops if the event cancel is set.
+    """
+
+    length = connect.info().getheader('Content-Length')
+    if (getattr(connect, 'code', None) == 206):
+        content_range = connect.info().getheader('Content-Range', '')
+        if not (content_range.startswith("bytes %i-" % (offset))):
+            offset = 0
+    else:
+        offset = 0
+    if (offset > 0):
+        fw = open(part, 'ab')
+    else:
+        fw = open(part, 'wb')
+    try:
+        while True:
+            chunk = connect.read(DOWNLOAD_CHUNK)
+            if not (chunk): break
+            if (cancel is not None) and (cancel.is_set()): return False
+            fw.write(chunk)
+        fw.flush()
+        os.fsync(fw.fileno())
+    finally:
+        fw.close()
+        connect.close()
+    if (length is not None):
+        return os.path.getsize(part) == offset + int(length)
+    return True
+
+
 def add_quote(string,double=False):
     if (double):
         return "\"" + string + "\""
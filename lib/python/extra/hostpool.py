@@ -0,0 +1,502 @@
+#! /usr/bin/env python
+# -*-coding:ASCII -*
+
+"""
+Module containing the process-wide limits of the requests
+sent to each remote host, their circuit breakers, and the
+http session sharing persistent connections to them.
+X.Bonnin (LESIA, CNRS)
+"""
+
+import threading
+import time
+import urlparse
+import urllib
+import urllib2
+import httplib
+import socket
+import base64
+import cStringIO
+
+# Default limits of a host
+# Max. number of requests per second (None for no limit)
+RATE = 5.0
+# Max. number of requests sent at once after an idle period
+BURST = 5
+# Max. number of connections opened at the same time
+MAX_CONNECTIONS = 8
+
+# Limits of the known hosts (rate, burst, max. connections)
+HOST_LIMITS = {"jsoc.stanford.edu": (2.0, 2, 4),
+               "jsoc2.stanford.edu": (2.0, 2, 4)}
+
+# Circuit breaker of a host
+# Number of consecutive failed requests opening the circuit
+BREAKER_FAILURES = 5
+# Time in sec. during which the requests to an open circuit fail at once
+BREAKER_COOLDOWN = 300.0
+
+
+class token_bucket:
+
+    """
+    Token bucket filled with rate tokens per second, up to burst tokens.
+    Each request takes one token, waiting for it if the bucket is empty.
+    """
+
+    def __init__(self, rate=RATE, burst=BURST):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not (self.rate):
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if (self.tokens >= 1.0):
+                    self.tokens -= 1.0
+                    return
+                delay = (1.0 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class host_limiter:
+
+    """
+    Limits of the requests sent to a host: a token bucket for
+    the request rate, and a semaphore for the number of connections.
+    To be used as a context manager around a request:
+
+        with get_limiter(url):
+            connect = urllib2.urlopen(url)
+            content = connect.read()
+    """
+
+    def __init__(self, host, rate=RATE, burst=BURST,
+                 max_connections=MAX_CONNECTIONS):
+        self.host = host
+        self.bucket = token_bucket(rate=rate, burst=burst)
+        self.max_connections = max(max_connections, 1)
+        self.connections = threading.BoundedSemaphore(self.max_connections)
+
+    def acquire(self):
+        self.connections.acquire()
+        try:
+            self.bucket.acquire()
+        except:
+            self.connections.release()
+            raise
+
+    def release(self):
+        self.connections.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+        return False
+
+
+class circuit_breaker:
+
+    """
+    Circuit breaker of a host, shared by all the threads.
+    The circuit opens after failures consecutive failed requests
+    (host unreachable, timeout or server error): the requests to
+    the host are then refused at once during cooldown sec.
+    After that, a single trial request is let through (half-open):
+    the circuit closes if it succeeds, or opens again if it fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, host, failures=BREAKER_FAILURES,
+                 cooldown=BREAKER_COOLDOWN):
+        self.host = host
+        self.failures = max(failures, 1)
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.nfailures = 0
+        self.opened = None
+        self.trial = None
+        self.trips = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+
+        """Returns True if a request can be sent to the host."""
+
+        with self.lock:
+            if (self.state == self.CLOSED):
+                return True
+            now = time.time()
+            if (self.state == self.OPEN) and \
+                    (now - self.opened >= self.cooldown):
+                self.state = self.HALF_OPEN
+                self.trial = None
+            # A trial which has not reported is given up after cooldown
+            if (self.state == self.HALF_OPEN) and \
+                    ((self.trial is None) or
+                     (now - self.trial >= self.cooldown)):
+                self.trial = now
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+
+        """Reports a request answered by the host."""
+
+        with self.lock:
+            self.state = self.CLOSED
+            self.nfailures = 0
+            self.trial = None
+
+    def failure(self):
+
+        """Reports a failed request to the host."""
+
+        with self.lock:
+            self.nfailures += 1
+            if (self.state == self.HALF_OPEN) or \
+                    (self.state == self.CLOSED and
+                     self.nfailures >= self.failures):
+                self.state = self.OPEN
+                self.opened = time.time()
+                self.trial = None
+                self.trips += 1
+
+    def status(self):
+
+        """Returns the state and the counters of the circuit."""
+
+        with self.lock:
+            return {"host": self.host, "state": self.state,
+                    "failures": self.nfailures, "trips": self.trips,
+                    "rejected": self.rejected}
+
+
+_LIMITERS = {}
+_BREAKERS = {}
+_LOCK = threading.Lock()
+
+
+def get_host(url):
+
+    """Returns the host name of url (or url itself if it has none)."""
+
+    host = urlparse.urlparse(url).hostname
+    if (host is None):
+        return url
+    return host.lower()
+
+
+def set_host_limit(host, rate=RATE, burst=BURST,
+                   max_connections=MAX_CONNECTIONS):
+
+    """
+    Set the limits of host. Requests already waiting keep
+    the former limits.
+    """
+
+    with _LOCK:
+        HOST_LIMITS[host.lower()] = (rate, burst, max_connections)
+        _LIMITERS.pop(host.lower(), None)
+
+
+def get_limiter(url):
+
+    """Returns the limiter shared by all the requests to the host of url."""
+
+    host = get_host(url)
+    with _LOCK:
+        limiter = _LIMITERS.get(host)
+        if (limiter is None):
+            rate, burst, max_connections = HOST_LIMITS.get(
+                host, (RATE, BURST, MAX_CONNECTIONS))
+            limiter = host_limiter(host, rate=rate, burst=burst,
+                                   max_connections=max_connections)
+            _LIMITERS[host] = limiter
+    return limiter
+
+
+def get_breaker(url):
+
+    """Returns the circuit breaker shared by all the requests to the host of url."""
+
+    host = get_host(url)
+    with _LOCK:
+        breaker = _BREAKERS.get(host)
+        if (breaker is None):
+            breaker = circuit_breaker(host)
+            _BREAKERS[host] = breaker
+    return breaker
+
+
+def breaker_states():
+
+    """Returns the status of the circuit breaker of each host requested so far."""
+
+    with _LOCK:
+        breakers = [_BREAKERS[host] for host in sorted(_BREAKERS)]
+    return [breaker.status() for breaker in breakers]
+
+
+class session_response:
+
+    """
+    Response of a http_session request, with the interface of the
+    urllib2 responses (info, read, getcode, geturl).
+    The connection goes back to the session once the response
+    has been read.
+    """
+
+    def __init__(self, session, key, connection, response, url):
+        self.session = session
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.code = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self.released = False
+
+    def info(self):
+        return self.response.msg
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        try:
+            if (amt is None):
+                data = self.response.read()
+            else:
+                data = self.response.read(amt)
+        except:
+            self._discard()
+            raise
+        if (amt is None) or not (data):
+            self._release()
+        return data
+
+    def _release(self):
+        if (self.released):
+            return
+        self.released = True
+        if (self.response.will_close):
+            self.connection.close()
+        else:
+            self.session._release(self.key, self.connection)
+
+    def _discard(self):
+        if (self.released):
+            return
+        self.released = True
+        self.connection.close()
+
+    def close(self):
+        if (self.response.isclosed()):
+            self._release()
+        else:
+            self._discard()
+
+
+class http_session:
+
+    """
+    Persistent http(s) connections to remote hosts, kept open between
+    requests (keep-alive), with the credentials and the timeout of
+    each host. A session can be shared by threads: each request uses
+    its own connection, which goes back to the session when the
+    response has been read.
+    Unlike urllib2.install_opener, it does not change any global state.
+    The requests to a host reached through a proxy (http_proxy,
+    https_proxy and no_proxy environment variables) are sent with
+    urllib2 instead, which honours the proxy settings, without
+    keeping the connections open.
+    """
+
+    # Max. number of redirections followed by a request
+    MAX_REDIRECTS = 5
+
+    def __init__(self, timeout=None, max_idle=MAX_CONNECTIONS):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle = {}
+        self.auth = {}
+        self.timeouts = {}
+        self.lock = threading.Lock()
+
+    def set_auth(self, url, user, passwd):
+
+        """Set the basic authentication credentials of the host of url."""
+
+        with self.lock:
+            self.auth[get_host(url)] = "Basic " + \
+                base64.b64encode("%s:%s" % (user, passwd))
+
+    def set_timeout(self, url, timeout):
+
+        """Set the default timeout in sec. of the host of url."""
+
+        with self.lock:
+            self.timeouts[get_host(url)] = timeout
+
+    def _connection(self, key, timeout):
+        with self.lock:
+            idle = self.idle.get(key)
+            if (idle):
+                connection = idle.pop()
+                connection.timeout = timeout
+                if (connection.sock is not None):
+                    connection.sock.settimeout(timeout)
+                return connection, True
+        scheme, netloc = key
+        if (scheme == "https"):
+            return httplib.HTTPSConnection(netloc, timeout=timeout), False
+        return httplib.HTTPConnection(netloc, timeout=timeout), False
+
+    def _release(self, key, connection):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if (len(idle) < self.max_idle):
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _headers(self, url, headers, timeout):
+
+        """Returns the headers and the timeout of a request to url."""
+
+        host = get_host(url)
+        with self.lock:
+            if (timeout is None):
+                timeout = self.timeouts.get(host, self.timeout)
+            all_headers = {}
+            if (host in self.auth):
+                all_headers["Authorization"] = self.auth[host]
+        if (headers):
+            all_headers.update(headers)
+        return all_headers, timeout
+
+    def _proxied(self, url):
+
+        """Returns True if url is to be requested through a proxy."""
+
+        scheme = urlparse.urlsplit(url).scheme
+        if (scheme not in urllib.getproxies()):
+            return False
+        return not (urllib.proxy_bypass(get_host(url)))
+
+    def _proxy_request(self, url, method, headers, timeout):
+
+        """
+        Sends a request with urllib2 through the proxy, and returns
+        its response. Raises urllib2.HTTPError if its status is an error.
+        """
+
+        all_headers, timeout = self._headers(url, headers, timeout)
+        request = urllib2.Request(url, headers=all_headers)
+        if (method != "GET"):
+            request.get_method = lambda: method
+        return urllib2.urlopen(request, None, timeout)
+
+    def _request(self, url, method, headers, timeout):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme or "http", parts.netloc)
+        path = parts.path or "/"
+        if (parts.query):
+            path += "?" + parts.query
+        all_headers, timeout = self._headers(url, headers, timeout)
+
+        while True:
+            connection, reused = self._connection(key, timeout)
+            try:
+                connection.request(method, path, headers=all_headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                # The server has closed an idle connection
+                if (reused):
+                    continue
+                if (isinstance(e, socket.timeout)):
+                    raise
+                raise urllib2.URLError(e)
+            return session_response(self, key, connection, response, url)
+
+    def request(self, url, method="GET", headers=None, timeout=None):
+
+        """
+        Sends a request, following redirections, and returns its
+        response whatever its status.
+        Raises urllib2.URLError if the host cannot be reached,
+        or socket.timeout.
+        """
+
+        if (self._proxied(url)):
+            try:
+                return self._proxy_request(url, method, headers, timeout)
+            except urllib2.HTTPError as e:
+                return e
+        for i in range(self.MAX_REDIRECTS + 1):
+            response = self._request(url, method, headers, timeout)
+            location = response.getheader("location")
+            if (response.status not in [301, 302, 303, 307]) or \
+                    (location is None):
+                break
+            response.read()
+            url = urlparse.urljoin(url, location)
+            if (response.status == 303):
+                method = "GET"
+        return response
+
+    def urlopen(self, url, timeout=None, headers=None):
+
+        """
+        Same as urllib2.urlopen(url, None, timeout), using the
+        connections of the session for the http(s) urls.
+        Raises urllib2.HTTPError if the response status is an error.
+        """
+
+        if (urlparse.urlsplit(url).scheme not in ["http", "https"]):
+            return urllib2.urlopen(url, None, timeout)
+        if (self._proxied(url)):
+            return self._proxy_request(url, "GET", headers, timeout)
+        response = self.request(url, headers=headers, timeout=timeout)
+        if (response.status >= 400):
+            content = response.read()
+            raise urllib2.HTTPError(response.geturl(), response.status,
+                                    response.reason, response.msg,
+                                    cStringIO.StringIO(content))
+        return response
+
+
+_SESSION = http_session()
+
+
+def get_session():
+
+    """Returns the http session shared by the whole process."""
+
+    return _SESSION
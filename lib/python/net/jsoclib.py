@@ -52,21 +52,187 @@ NEAR_DATE = TODAY.strftime(INPUT_TIMEFORMAT)
 SPAN_DURATION = 3600
 # Retrieving method
 METHOD = "url"
+# Quick retrieving method, complete at once if the data are online
+METHOD_QUICK = "url_quick"
 #Time out in sec.
 TIMEOUT = 120
 # OUTPUT JSOC SERVER RESPONSE FORMAT
 FORMAT = "json"
 # Protocol
 PROTOCOL = "fits"
-# Time to wait in seconds before sending a exp_status request
-WAIT = 10
+# Protocols of the compressed fits files ("fits,compress Rice")
+COMPRESS_PROTOCOLS = {"rice": "fits,compress%20Rice"}
+# Requests to the jsoc servers are paced by the host limiters
+# of MyToolkit.download_file (see hostpool.HOST_LIMITS)
+# Delay in sec. before the first exp_status query of an export request,
+# doubled after each query (see export_poller)
+POLL_DELAY = 1.0
+# Max. delay in sec. between two exp_status queries of an export request
+MAX_POLL_DELAY = 30.0
+# Time out in sec. of an exp_status query sent by the export_poller
+POLL_TIMEOUT = 30.0
+# Duration in sec. of the chunks of the show_info_cache
+INFO_CHUNK = 86400
+# Chunks ending less than INFO_RECENT sec. ago are always requested
+INFO_RECENT = 86400
+# Origin of the dates converted into seconds
+EPOCH = datetime(1970, 1, 1)
+
+def record_filename(record, segment=None):
+
+    """
+    Returns the local filename of a record, e.g.
+    hmi.Ic_45s_nrt[2014.02.21_00:00:00_TAI][2]{continuum} ->
+    hmi.Ic_45s_nrt.2014.02.21_00:00:00_TAI.continuum.fits
+    segment is used if the record does not give it.
+    """
+
+    if (segment) and ('{' not in record):
+        record = record + '{' + segment + '}'
+    filename = record.replace('][2]', '')
+    filename = filename.replace('{', '.')
+    filename = filename.replace('[', '.')
+    filename = filename.replace(']', '')
+    filename = filename.replace('}', '')
+    return filename+'.fits'
+
+
+class pending_export:
+
+    """Export request waiting in the export_poller."""
+
+    def __init__(self, client, requestid, timeout):
+        self.client = client
+        self.requestid = requestid
+        self.deadline = time.time() + timeout
+        self.delay = POLL_DELAY
+        self.next_poll = time.time() + self.delay
+        self.response = None
+        self.done = threading.Event()
+
+    def wait(self, cancel=None):
+
+        """
+        Waits for the end of the export and returns the last
+        jsoc_fetch response (None if it has failed or timed out,
+        or if cancel is set).
+        The deadline is checked here as well, so that a poller
+        blocked on a query does not hold the waiting threads.
+        """
+
+        while not (self.done.wait(1.0)):
+            if ((cancel is not None) and (cancel.is_set())) or \
+                    (time.time() > self.deadline):
+                get_poller().remove(self)
+                return None
+        return self.response
+
+
+class export_poller(threading.Thread):
+
+    """
+    Single thread polling the status of all the pending jsoc export
+    requests of the process. Each request is queried with a delay
+    doubled after each query (from POLL_DELAY to MAX_POLL_DELAY), and
+    the threads waiting for it are woken up when it is complete,
+    has failed or has timed out.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pending = []
+        self.condition = threading.Condition()
+
+    def add(self, client, requestid, timeout=TIMEOUT):
+
+        """
+        Adds the export request requestid, which status is queried
+        with the jsoc client, and returns its pending_export.
+        """
+
+        pending = pending_export(client, requestid, timeout)
+        with self.condition:
+            self.pending.append(pending)
+            self.condition.notify()
+        return pending
+
+    def remove(self, pending):
+
+        """Stops polling the pending export."""
+
+        with self.condition:
+            if (pending in self.pending):
+                self.pending.remove(pending)
+        pending.done.set()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not (self.pending):
+                    self.condition.wait()
+                now = time.time()
+                due = [pending for pending in self.pending
+                       if (pending.next_poll <= now)]
+                if not (due):
+                    self.condition.wait(
+                        min([pending.next_poll for pending in self.pending]) - now)
+                    continue
+            for pending in due:
+                self.poll(pending)
+
+    def poll(self, pending):
+
+        """Queries the status of the pending export."""
+
+        if (time.time() > pending.deadline):
+            print "Export %s has timed out" % (pending.requestid)
+            pending.response = None
+            self.remove(pending)
+            return
+        try:
+            fetch_resp = pending.client.fetch("exp_status",
+                                              requestid=pending.requestid,
+                                              format=FORMAT,
+                                              timeout=POLL_TIMEOUT)
+            status = int(fetch_resp['status'])
+        except Exception:
+            pending.response = None
+            self.remove(pending)
+            return
+        pending.response = fetch_resp
+        # 1: export in progress, 2: export queued
+        if (status in [1, 2]):
+            if (pending.client.verbose): print "Status: %i for %s" % (status, pending.requestid)
+            pending.delay = min(pending.delay * 2, MAX_POLL_DELAY)
+            pending.next_poll = time.time() + pending.delay
+            return
+        self.remove(pending)
+
+
+_POLLER = None
+_POLLER_LOCK = threading.Lock()
+
+
+def get_poller():
+
+    """Returns the export_poller of the process, started at first call."""
+
+    global _POLLER
+    with _POLLER_LOCK:
+        if (_POLLER is None):
+            _POLLER = export_poller()
+            _POLLER.start()
+    return _POLLER
+
 
 class jsoc():
 
     def __init__(self, dataseries, realtime=False, near_date=NEAR_DATE,
                  starttime=None, endtime=None,
                  cadence=None, span_duration=None,
-                 verbose=False,notify=None):
+                 verbose=False,notify=None,
+                 compress=None):
 
         self.ds = dataseries
         self.realtime = realtime
@@ -82,6 +248,17 @@ class jsoc():
         self.url = ""
         self.verbose = verbose
         self.notify = notify
+        # Compression of the exported fits files (None or "rice")
+        self.compress = compress
+        if (compress is None):
+            self.protocol = PROTOCOL
+        else:
+            try:
+                self.protocol = COMPRESS_PROTOCOLS[compress.lower()]
+            except KeyError:
+                raise ValueError("Unknown compression: %s" % (compress))
+        # Wall-clock time in sec. spent in each stage of the last get_fits
+        self.timing = {}
 
         if (starttime is not None) and (endtime is not None):
             tstart = starttime.strftime(JSOC_TIMEFORMAT)
@@ -173,7 +350,8 @@ class jsoc():
 
     def fetch(self, operation,
               protocol=None, method=None,
-              requestid=None, format=None):
+              requestid=None, format=None,
+              timeout=None):
 
         url = self.build_fetch(operation,
                                protocol=protocol,
@@ -182,9 +360,10 @@ class jsoc():
                                format=format)
         print "Fetching %s" % (url)
         if self.realtime:
-            resp = download_file(url, get_stream=True, user='hmiteam', passwd='hmiteam')
+            resp = download_file(url, get_stream=True, timeout=timeout,
+                                 user='hmiteam', passwd='hmiteam')
         else:
-            resp = download_file(url, get_stream=True)
+            resp = download_file(url, get_stream=True, timeout=timeout)
         if not (resp.startswith("{")):
             print "Empty jsoc_fetch response!"
             print "Query was: %s" % (url)
@@ -195,26 +374,122 @@ class jsoc():
         self.fetch_resp = fetch_resp
         return fetch_resp
 
-    def get_fits(self, output_dir=CURRENT_DIR, timeout=TIMEOUT, wait=WAIT):
+    def get_urls(self, fetch_resp):
+
+        """
+        Returns a dictionary record -> download url
+        of the files listed in a jsoc_fetch response.
+        """
+
+        if self.realtime:
+            main_url = JSOC2_MAINURL
+        else:
+            main_url = JSOC_MAINURL
+        urls = {}
+        for data in fetch_resp.get('data', []):
+            try:
+                record = data['record']
+                filename = data['filename']
+            except (KeyError, TypeError):
+                continue
+            if (filename.startswith('/')) or not (fetch_resp.get('dir')):
+                urls[record] = main_url + filename
+            else:
+                urls[record] = main_url + fetch_resp['dir'] + '/' + filename
+        return urls
+
+    def request_export(self, quick=True):
+
+        """
+        Sends the export request of the records.
+        If quick is True, a quick export is tried first: it is complete
+        at once if the data are online. If they are not, jsoc turns it
+        into a staged export, which is returned to be polled as usual.
+        A staged export is requested if the quick one has failed.
+        """
+
+        if (quick):
+            fetch_resp = self.fetch("exp_request", protocol=self.protocol, method=METHOD_QUICK)
+            if (fetch_resp is not None) and ('status' in fetch_resp):
+                status = int(fetch_resp['status'])
+                if (status == 0) and (fetch_resp.get('data')):
+                    return fetch_resp
+                # 1: export in progress, 2: export queued
+                if (status in [1, 2]) and (fetch_resp.get('requestid')):
+                    if (self.verbose): print "Data not online, polling %s" % (fetch_resp['requestid'])
+                    return fetch_resp
+        return self.fetch("exp_request", protocol=self.protocol, method=METHOD)
+
+    def export(self, timeout=TIMEOUT, quick=True):
+
+        """
+        Sends a single export request for all the records of the
+        dataseries in the time range (and cadence), and waits for it
+        (see request_export for quick).
+        Returns a dictionary record -> download url, which is
+        empty if the export has failed.
+        """
+
+        self.timing = {"exp_request": 0.0, "exp_status": 0.0}
+        t0 = time.time()
+        fetch_resp = self.request_export(quick=quick)
+        self.timing["exp_request"] = time.time() - t0
+        if (fetch_resp is None) or ('status' not in fetch_resp):
+            return {}
+
+        t0 = time.time()
+        requestid = fetch_resp.get('requestid')
+        status = int(fetch_resp['status'])
+        # 1: export in progress, 2: export queued
+        if (status in [1, 2]) and (requestid is not None):
+            fetch_resp = self.wait_export(requestid, timeout=timeout)
+        self.timing["exp_status"] = time.time() - t0
+
+        if (fetch_resp is None) or (int(fetch_resp.get('status', -1)) != 0):
+            print "Export of %s%s has failed: %s" % (self.ds, self.tr, fetch_resp)
+            return {}
+        return self.get_urls(fetch_resp)
+
+    def wait_export(self, requestid, timeout=TIMEOUT, cancel=None):
+
+        """
+        Waits for the export request requestid, which is polled with
+        the other pending requests by the export_poller of the process.
+        Returns the last jsoc_fetch response, or None if the export has
+        timed out, if its status cannot be fetched, or if cancel is set.
+        """
+
+        pending = get_poller().add(self, requestid, timeout)
+        return pending.wait(cancel=cancel)
+
+    def get_fits(self, output_dir=CURRENT_DIR, timeout=TIMEOUT, quick=True,
+                 cancel=None, started=None):
+
+        """
+        Exports the first record and downloads it in output_dir.
+        Returns the downloaded file, or '' if it has failed.
+        cancel and started are passed to download_file, the export
+        polling being stopped as well if cancel is set.
+        """
 
         res = ''
-        fetch_resp = self.fetch("exp_request", protocol=PROTOCOL, method=METHOD)
-        if (fetch_resp is None): sys.exit(0)
-        if (fetch_resp['status'] == 0):
+        self.timing = {"exp_request": 0.0, "exp_status": 0.0, "download": 0.0}
+        t0 = time.time()
+        fetch_resp = self.request_export(quick=quick)
+        self.timing["exp_request"] = time.time() - t0
+        if (fetch_resp is None): return ''
+        if (int(fetch_resp['status']) == 0):
             #downloading file from info given in the response
             data = fetch_resp['data'][0]
-            filename = data['record']
-            filename = filename.replace('][2]{', '.')
-            filename = filename.replace('[', '.')
-            filename = filename.replace('}', '')
-#            filename = filename.replace(':', '_')
-            filename = filename+'.fits'
+            filename = record_filename(data['record'])
+            t1 = time.time()
             if self.realtime:
                 download_url = 'http://jsoc2.stanford.edu'+data['filename']
-                res = download_file(download_url, target_directory=output_dir, filename=filename, user='hmiteam', passwd='hmiteam')
+                res = download_file(download_url, target_directory=output_dir, filename=filename, user='hmiteam', passwd='hmiteam', cancel=cancel, started=started)
             else:
                 download_url = 'http://jsoc.stanford.edu'+data['filename']
-                res = download_file(download_url, target_directory=output_dir, filename=filename)
+                res = download_file(download_url, target_directory=output_dir, filename=filename, cancel=cancel, started=started)
+            self.timing["download"] = time.time() - t1
 
             if (self.verbose): print "Downloading %s to %s ..." % (download_url, output_dir+filename)
 
@@ -225,52 +500,185 @@ class jsoc():
                 print "Error: no JSOC request ID: %s" % (self.fetch_resp)
                 return ''
             
-            t0 = time.time();
-            remaining_sec = timeout - int(time.time() - t0)
-            time.sleep(3)
-            while (remaining_sec >= 0):                
-                fetch_resp = self.fetch("exp_status", requestid=requestid, format=FORMAT)
-                if (self.verbose): print "%s    (remaining time: %i sec.)" % (self.fetch_resp, remaining_sec)                
-                if (fetch_resp is None): 
-                    print "Fetching status error!"
-                    res = ''
-                    break
-                try:
-                    status = int(fetch_resp['status'])
-                except KeyError:
-                    print "Error: no status in response: %s" % (self.fetch_resp)
-                    res = ''
-                    break
-                if (status == 0):
-                    try:
-                        size = int(fetch_resp['size'])
-                    except KeyError:
-                        print "Error: no size in response: %s" % (self.fetch_resp)
-                        res = ''
-                        break 
-                    if (size > 0):                    
-                        data = fetch_resp['data'][0]
-                        filename = data['record']
-                        filename = filename.replace('][2]', '')
-                        filename = filename.replace('[', '.')
-                        tmp = data['filename'].split('.')
-                        filename = filename+'.'+tmp[3]+'.fits'
-                        if self.realtime:
-                            download_url = 'http://jsoc2.stanford.edu'+fetch_resp['dir']+'/'+data['filename']
-                            res = download_file(download_url, target_directory=output_dir, filename=filename, user='hmiteam', passwd='hmiteam')
-                        else:
-                            download_url = 'http://jsoc.stanford.edu'+fetch_resp['dir']+'/'+data['filename']
-                            res = download_file(download_url, target_directory=output_dir, filename=filename)
-                        if (self.verbose): print "Downloading %s to %s ..." % (download_url, output_dir+filename)
-
-                    else:
-                        res = ''
-                    break
+            t0 = time.time()
+            fetch_resp = self.wait_export(requestid, timeout=timeout, cancel=cancel)
+            self.timing["exp_status"] = time.time() - t0
+            if (fetch_resp is None):
+                print "Fetching status error!"
+                return ''
+            try:
+                status = int(fetch_resp['status'])
+            except KeyError:
+                print "Error: no status in response: %s" % (fetch_resp)
+                return ''
+            if (status != 0):
+                print "Status: %i for %s" % (status, requestid)
+                return ''
+            try:
+                size = int(fetch_resp['size'])
+            except KeyError:
+                print "Error: no size in response: %s" % (fetch_resp)
+                return ''
+            if (size > 0):
+                data = fetch_resp['data'][0]
+                # The segment of the exported file (*.continuum.fits)
+                tmp = os.path.basename(data['filename']).split('.')
+                segment = None
+                if (len(tmp) > 2): segment = tmp[-2]
+                filename = record_filename(data['record'], segment=segment)
+                t1 = time.time()
+                if self.realtime:
+                    download_url = 'http://jsoc2.stanford.edu'+fetch_resp['dir']+'/'+data['filename']
+                    res = download_file(download_url, target_directory=output_dir, filename=filename, user='hmiteam', passwd='hmiteam', cancel=cancel, started=started)
                 else:
-                    print "Status: %i for %s" % (status, requestid)
-                time.sleep(WAIT)
-                remaining_sec = remaining_sec = timeout - int(time.time() - t0)
-            return res
+                    download_url = 'http://jsoc.stanford.edu'+fetch_resp['dir']+'/'+data['filename']
+                    res = download_file(download_url, target_directory=output_dir, filename=filename, cancel=cancel, started=started)
+                self.timing["download"] = time.time() - t1
+                if (self.verbose): print "Downloading %s to %s ..." % (download_url, output_dir+filename)
+        return res
+
+class show_info_cache:
+
+    """
+    On-disk cache of the (T_REC_index, T_REC) listings of show_info.
+
+    The requested time range is split into chunks of about chunk sec.
+    (a multiple of the cadence), aligned on the cadence steps of the
+    range, which are stored as JSON files in
+    directory/<dataseries>/<cadence>/<chunk start>.json.
+    Only the missing chunks and the recent ones (ending less than
+    recent sec. ago), which may still change, are requested, each run
+    of contiguous chunks by a single show_info query.
+    """
+
+    def __init__(self, directory, chunk=INFO_CHUNK, recent=INFO_RECENT,
+                 realtime=False, verbose=False):
+        self.directory = directory
+        self.chunk = chunk
+        self.recent = recent
+        self.realtime = realtime
+        self.verbose = verbose
+
+    def _grid(self, starttime, cadence):
+        # Chunks start at origin + k * length seconds since 1970-01-01,
+        # on the cadence steps from starttime
+        start = _seconds(starttime)
+        if (cadence is None):
+            return 0, self.chunk
+        length = max(self.chunk // cadence, 1) * cadence
+        return start % cadence, length
+
+    def _path(self, ds, cadence, origin, first):
+        step = "all" if (cadence is None) else "%is_%is" % (cadence, origin)
+        return os.path.join(self.directory, ds, step, "%i.json" % (first))
+
+    def _load(self, path):
+        try:
+            with open(path) as fr:
+                chunk = json.load(fr)
+            return chunk["T_REC_index"], chunk["T_REC"]
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def _save(self, path, index, trec):
+        if not (os.path.isdir(os.path.dirname(path))):
+            os.makedirs(os.path.dirname(path))
+        part = path + ".%i.part" % (os.getpid())
+        with open(part, 'w') as fw:
+            json.dump({"T_REC_index": index, "T_REC": trec}, fw)
+        os.rename(part, path)
+
+    def _fetch(self, ds, first, last, cadence):
+        # Returns the records between first and last seconds (included)
+        # or None if the query has failed
+        client = jsoc(ds, realtime=self.realtime,
+                      starttime=EPOCH + timedelta(seconds=first),
+                      endtime=EPOCH + timedelta(seconds=last),
+                      cadence=cadence, verbose=self.verbose)
+        info = client.show_info(key=["T_REC_index", "T_REC"])
+        if not (info):
+            return None
+        records = []
+        for row in info.split("\n")[1:]:
+            if (row):
+                rs = row.split()
+                records.append((rs[0], rs[1]))
+        return records
+
+    def records(self, ds, starttime, endtime, cadence=None):
+
+        """
+        Returns the lists of T_REC_index and T_REC (strings) of the
+        records of ds between starttime and endtime, at cadence sec.
+        (same as show_info on this range), or ([], []) if a query
+        has failed.
+        """
+
+        origin, length = self._grid(starttime, cadence)
+        start = _seconds(starttime)
+        end = _seconds(endtime)
+        recent = _seconds(datetime.utcnow()) - self.recent
+        first = start - (start - origin) % length
+
+        chunks = []
+        missing = []
+        while (first <= end):
+            path = self._path(ds, cadence, origin, first)
+            chunk = None
+            if (first + length <= recent):
+                chunk = self._load(path)
+            if (chunk is None):
+                missing.append(len(chunks))
+            chunks.append([first, path, chunk])
+            first += length
+
+        # A single query for each run of contiguous missing chunks
+        runs = []
+        for i in missing:
+            if (runs) and (runs[-1][-1] == i - 1):
+                runs[-1].append(i)
+            else:
+                runs.append([i])
+        for run in runs:
+            run_first = chunks[run[0]][0]
+            run_last = chunks[run[-1]][0] + length - 1
+            records = self._fetch(ds, run_first, run_last, cadence)
+            if (records is None):
+                return [], []
+            for i in run:
+                chunks[i][2] = ([], [])
+            for index, trec in records:
+                i = run[0] + (_seconds(trec) - run_first) // length
+                if (i in run):
+                    chunks[i][2][0].append(index)
+                    chunks[i][2][1].append(trec)
+            for i in run:
+                chunk_first, path, chunk = chunks[i]
+                if (chunk_first + length <= recent):
+                    self._save(path, chunk[0], chunk[1])
+
+        ic_index = []
+        ic_trec = []
+        for chunk_first, path, chunk in chunks:
+            for index, trec in zip(chunk[0], chunk[1]):
+                if (start <= _seconds(trec) <= end):
+                    ic_index.append(index)
+                    ic_trec.append(trec)
+        return ic_index, ic_trec
+
+
+def _seconds(date):
+
+    """
+    Returns the seconds since 1970-01-01 of a datetime
+    or of a T_REC string (YYYY.MM.DD_hh:mm:ss[_TAI]).
+    """
+
+    if not (isinstance(date, datetime)):
+        date = datetime.strptime(date[:19], JSOC_TIMEFORMAT)
+    delta = date - EPOCH
+    return delta.days * 86400 + delta.seconds
+
 
 # python jsoclib.py hmi.Ic_45s_nrt -nrt -s 2020-09-06T00:00:01 -e 2020-09-06T06:00:00 -c 7200  -V -S
 if (__name__ == "__main__"):
@@ -292,6 +700,8 @@ if (__name__ == "__main__"):
                         default=None, help="Target directory for downloaded files.")
     parser.add_argument('-S', '--SHOW_INFO', action='store_true',
                         help="Perform show_info request for dataseries")
+    parser.add_argument('-R', '--RICE', action='store_true',
+                        help="Export Rice-compressed fits files")
     parser.add_argument('-V', '--VERBOSE', action='store_true',
                         help="Verbose mode")
     parser.add_argument('-n', '--notify', nargs='?', 
@@ -308,6 +718,8 @@ if (__name__ == "__main__"):
     output_dir = args.output_dir
     show_info = args.SHOW_INFO
     verbose = args.VERBOSE
+    compress = None
+    if (args.RICE): compress = "rice"
     notify = args.notify
 
     if (starttime is not None): starttime = datetime.strptime(starttime, INPUT_TIMEFORMAT)
@@ -317,7 +729,8 @@ if (__name__ == "__main__"):
     jsoc = jsoc(ds, realtime=True, near_date=near_date, starttime=starttime,
                 endtime=endtime, cadence=cadence,
                 span_duration=span_duration,
-                verbose=verbose, notify='christian.renie@obspm.fr')
+                verbose=verbose, notify='christian.renie@obspm.fr',
+                compress=compress)
 
     if (args.SHOW_INFO):
         info = jsoc.show_info(key=["T_REC_index", "T_REC"])
@@ -14,6 +14,8 @@ __date__="19-JUL-2013"
 
 import os, sys, socket
 import logging
+import json
+from datetime import datetime
 import numpy as np
 from MyToolkit import read_csv, uniq, indices
 from ssw import tim2jd
@@ -22,6 +24,13 @@ from ssw import tim2jd
 LOGGER="sdoss_tracking"
 LOG = logging.getLogger(LOGGER)
 
+# Relative margin of the cells of the candidate_pairs grid
+GRID_MARGIN=1.0e-6
+# Number of candidate pairs compared at once by match_pairs
+PAIR_BLOCK=65536
+# Time format of the online_tracker state file
+STATE_TFORMAT="%Y-%m-%dT%H:%M:%S"
+
 def pre_hg_long(lon,lat,day,pre_day):
 
     """
@@ -34,18 +43,203 @@ def pre_hg_long(lon,lat,day,pre_day):
     jday=np.sum(tim2jd(day))
     pre_jday=np.sum(tim2jd(pre_day))
 
+    return pre_hg_long_jd(lon,lat,jday,pre_jday)
+
+def pre_hg_long_jd(lon,lat,jday,pre_jday):
+
+    """
+    Same as pre_hg_long, for julian days jday and pre_jday.
+    Works on scalars as well as on arrays.
+    """
+
+    # np.power calls pow() as the ** of numpy scalars does,
+    # whereas ** on arrays squares by a multiplication
     pre_lon=((pre_jday - jday) * 
-             (14.48 - 2.16*(np.sin(np.radians(lat))**2)) 
+             (14.48 - 2.16*np.power(np.sin(np.radians(lat)),2)) 
              + lon)
 
     return pre_lon
 
+def match_pairs(pair_i,pair_j,jday,feat_hg_long_deg,feat_hg_lat_deg,
+                radius=5.0,dt_max=86400):
+
+    """
+    Compares the features pair_i[k] and pair_j[k] of each pair k,
+    by blocks of PAIR_BLOCK pairs.
+    Returns the arrays of distance (in degrees, after the rotation of
+    feature i to the date of feature j), of time difference (in sec.)
+    and of matching (distance <= radius and time difference < dt_max).
+    """
+
+    npair=len(pair_i)
+    dist=np.zeros(npair,dtype=np.float64)
+    dt_ij=np.zeros(npair,dtype=np.float64)
+    for first in range(0,npair,PAIR_BLOCK):
+        i=pair_i[first:first + PAIR_BLOCK]
+        j=pair_j[first:first + PAIR_BLOCK]
+        pre_long_i=pre_hg_long_jd(feat_hg_long_deg[i],feat_hg_lat_deg[i],jday[i],jday[j])
+        dist[first:first + PAIR_BLOCK]=np.sqrt(np.power(feat_hg_long_deg[j] - pre_long_i,2) +
+                                               np.power(feat_hg_lat_deg[j] - feat_hg_lat_deg[i],2))
+        dt_ij[first:first + PAIR_BLOCK]=np.abs(jday[i] - jday[j])*24*3600
+    with np.errstate(invalid='ignore'):
+        match=(dist <= radius) & (dt_ij < dt_max)
+    return dist, dt_ij, match
+
+def candidate_pairs(jday,feat_hg_long_deg,feat_hg_lat_deg,valid,
+                    radius=5.0,dt_max=86400):
+
+    """
+    Returns for each feature the sorted list of the other valid features
+    which can be matched with it, i.e. less than dt_max sec. apart and
+    within radius degrees once the longitude is corrected for rotation
+    (see pre_hg_long).
+    The valid features are hashed on a grid over (time,
+    longitude rotated at 14.48 deg/day, latitude), which cells are large
+    enough for the matching pairs to be in neighbouring cells:
+    the rotation rate of a feature differs from 14.48 deg/day by at most
+    2.16 deg/day, so the rotated longitudes of a pair differ by at most
+    radius + 2.16*dt_max/86400 deg.
+    """
+
+    nfeat=len(jday)
+    candidates=[[] for i in range(nfeat)]
+    if (radius < 0.0) or (dt_max <= 0.0): return candidates
+
+    jday=np.asarray(jday,dtype=np.float64)
+    lon=np.asarray(feat_hg_long_deg,dtype=np.float64)
+    lat=np.asarray(feat_hg_lat_deg,dtype=np.float64)
+    valid=[i for i in valid
+           if (np.isfinite(jday[i]) and np.isfinite(lon[i]) and np.isfinite(lat[i]))]
+    if (len(valid) == 0): return candidates
+
+    # Cell sizes, with a margin for the rounding errors
+    dt_day=float(dt_max)/86400.0
+    size=np.array([dt_day,radius + 2.16*dt_day,radius],dtype=np.float64)
+    size=np.maximum(size*(1.0 + GRID_MARGIN),GRID_MARGIN)
+
+    jday0=np.min(jday[valid])
+    rot_lon=lon - 14.48*(jday - jday0)
+    coords=np.array([jday - jday0,rot_lon,lat]).T
+    cells={}
+    for i in valid:
+        cell=tuple(np.floor(coords[i]/size).astype(np.int64))
+        cells.setdefault(cell,[]).append(i)
+
+    neighbours=[(a,b,c) for a in (-1,0,1) for b in (-1,0,1) for c in (-1,0,1)]
+    for cell,members in cells.items():
+        current=[]
+        for a,b,c in neighbours:
+            current.extend(cells.get((cell[0]+a,cell[1]+b,cell[2]+c),[]))
+        current.sort()
+        for i in members:
+            candidates[i]=[j for j in current if (j != i)]
+
+    return candidates
+
+def accepted_pairs(jday,feat_hg_long_deg,feat_hg_lat_deg,valid,
+                   radius=5.0,dt_max=86400):
+
+    """
+    Returns the pairs (i,j) of matching features, sorted by i then j,
+    and the level of trust term of each pair, in the way tracking
+    compares the features in their order: a pair matched from its
+    first feature is not compared again from the second one.
+    """
+
+    nfeat=len(jday)
+    candidates=candidate_pairs(jday,feat_hg_long_deg,feat_hg_lat_deg,valid,
+                               radius=radius,dt_max=dt_max)
+    pair_i=np.repeat(np.arange(nfeat,dtype=np.int64),[len(current) for current in candidates])
+    pair_j=np.array([j for current in candidates for j in current],dtype=np.int64)
+    dist,dt_ij,match=match_pairs(pair_i,pair_j,jday,
+                                 np.array(feat_hg_long_deg,dtype=np.float64),
+                                 np.array(feat_hg_lat_deg,dtype=np.float64),
+                                 radius=radius,dt_max=dt_max)
+
+    # The pairs are sorted by i then j, and the candidate lists are symmetric
+    key=pair_i*nfeat + pair_j
+    reverse=np.searchsorted(key,pair_j*nfeat + pair_i)
+    accepted=match & ~((pair_j < pair_i) & match[reverse])
+
+    terms=0.5*((1.0 - 0.5*(dist[accepted]/radius)) + (1.0 - 0.5*(dt_ij[accepted]/dt_max)))
+    return pair_i[accepted], pair_j[accepted], terms
+
+def trust_levels(nfeat,pair_i,terms):
+
+    """
+    Returns the level of trust of each feature i: the mean of the terms
+    of its pairs (i,j), summed in the order of j (cumsum adds them one
+    by one), 0 if it has none.
+    """
+
+    lvl_trust=np.zeros(nfeat,dtype=np.float)
+    bounds=np.flatnonzero(np.diff(pair_i)) + 1
+    for current in np.split(np.arange(len(pair_i)),bounds):
+        if (len(current) == 0): continue
+        count_i=float(len(current))
+        lvl_trust[pair_i[current[0]]]=100.0*(np.cumsum(terms[current])[-1]/count_i)
+    return lvl_trust
+
+class track_graph:
+
+    """
+    Disjoint sets (union-find) of the features belonging to the same
+    track, with path compression and union by min. track id: each set
+    is labelled by the smallest track id of its features.
+    The merge edges (pairs of matched features) are kept in edges.
+    """
+
+    def __init__(self,track_id):
+        self.parent=range(len(track_id))
+        self.label=list(track_id)
+        self.edges=[]
+        # Features with the same input track id are in the same track
+        first={}
+        for i,current_id in enumerate(self.label):
+            if (current_id in first):
+                self._link(self.find(first[current_id]),self.find(i))
+            else:
+                first[current_id]=i
+
+    def find(self,i):
+
+        """Returns the root feature of the set of feature i."""
+
+        root=i
+        while (self.parent[root] != root):
+            root=self.parent[root]
+        while (self.parent[i] != root):
+            self.parent[i],i=root,self.parent[i]
+        return root
+
+    def _link(self,root_i,root_j):
+        if (root_i == root_j): return
+        if (self.label[root_j] < self.label[root_i]):
+            root_i,root_j=root_j,root_i
+        self.parent[root_j]=root_i
+
+    def union(self,i,j):
+
+        """Merges the tracks of the matched features i and j."""
+
+        self.edges.append((i,j))
+        self._link(self.find(i),self.find(j))
+
+    def track_id(self):
+
+        """Returns the track id of each feature."""
+
+        return np.array([self.label[self.find(i)] for i in range(len(self.parent))],
+                        dtype=np.int64)
+
 def tracking(date_obs,feat_x_pix,feat_y_pix,feat_hg_long_deg,feat_hg_lat_deg,feat_area_deg2,
-             radius=5.0,dt_max=86400,area_min=0.0,track_id=None):
+             radius=5.0,dt_max=86400,area_min=0.0,track_id=None,
+             return_graph=False):
 
     """
     Compute tracking of input features.
-    Returns track id and corresponding level of trust.
+    Returns track id and corresponding level of trust
+    (and the track_graph of the features if return_graph is True).
     """
     
     nfeat=len(date_obs)
@@ -67,46 +261,140 @@ def tracking(date_obs,feat_x_pix,feat_y_pix,feat_hg_long_deg,feat_hg_lat_deg,fea
             return None
         track_id=np.array(track_id,dtype=np.int64)
 
-    lvl_trust=np.zeros(nfeat,dtype=np.float) ; processed=[]
-    for i,current_date_i in enumerate(date_obs):
-
-        if (feat_area_deg2[i] < area_min): continue
-        feat_long_i = feat_hg_long_deg[i]
-        feat_lat_i = feat_hg_lat_deg[i]
-        lvl_trust_i=0.0 ; count_i=0.0 
-        for j,current_date_j in enumerate(date_obs):
-
-            if (feat_area_deg2[j] < area_min): continue
-            if (i == j): continue
-            if ([i,j] in processed) or ([j,i] in processed): continue
-            feat_long_j = feat_hg_long_deg[j]
-            feat_lat_j = feat_hg_lat_deg[j]
-            pre_long_i = pre_hg_long(feat_long_i,feat_lat_i,current_date_i,current_date_j)
-
-            dist = np.sqrt((feat_long_j - pre_long_i)**2 +(feat_lat_j-feat_lat_i)**2)
-            dt_ij=np.abs(np.sum(tim2jd(current_date_i)) - np.sum(tim2jd(current_date_j)))*24*3600 
-
-            if (dist <= radius) and (dt_ij < dt_max):
-                cond_k = (track_id == track_id[i]) | (track_id == track_id[j])
-                k=np.where(cond_k)
-                #k=indices(track_id,track_id[i])
-                #k.extend(indices(track_id,track_id[j]))
-                #k=uniq(k)
-                track_id[k]=np.min(track_id[k]) 
-                lvl_trust_i+=0.5*((1.0 - 0.5*(dist/radius)) + (1.0 - 0.5*(dt_ij/dt_max)))
-                count_i+=1.0
-                processed.append([i,j])
-
-        if (count_i > 0.0): lvl_trust[i]=100.0*(lvl_trust_i/count_i)
+    # Only the pairs of features close in time and space are compared
+    jday=np.array([np.sum(tim2jd(current_date)) for current_date in date_obs],dtype=np.float64)
+    valid=[i for i in range(nfeat) if not (feat_area_deg2[i] < area_min)]
+    pair_i,pair_j,terms=accepted_pairs(jday,feat_hg_long_deg,feat_hg_lat_deg,valid,
+                                       radius=radius,dt_max=dt_max)
+
+    graph=track_graph(track_id)
+    for i,j in zip(pair_i,pair_j):
+        graph.union(i,j)
+    lvl_trust=trust_levels(nfeat,pair_i,terms)
             
+    track_id=graph.track_id()
+    if (return_graph):
+        return track_id, lvl_trust, graph
     return track_id, lvl_trust
-                
 
-                
+class online_tracker:
 
-    
+    """
+    Incremental tracking of the features, one file at a time.
 
+    The features of a new file are compared (as in tracking) with the
+    active features, i.e. the ones seen less than dt_max sec. before,
+    and with each other. A new feature takes the smallest track id of
+    the features it matches, or a new track id. Its level of trust is
+    the mean of the terms of the pairs it belongs to (tracking only
+    counts the pairs with the later features, which are not known yet).
+    Unlike tracking on sliding windows, the track ids of the
+    features of the previous files are never changed: when a new
+    feature merges two tracks, only the active features take the
+    merged id.
 
-    
+    The active features (dates, coordinates and track ids), the max.
+    track id and the date of the last file are kept in a JSON state
+    file (see load and save), so that each file is tracked once.
+    """
+
+    def __init__(self,radius=5.0,dt_max=86400,area_min=0.0):
+        self.radius=radius
+        self.dt_max=dt_max
+        self.area_min=area_min
+        self.jday=np.zeros(0,dtype=np.float64)
+        self.lon=np.zeros(0,dtype=np.float64)
+        self.lat=np.zeros(0,dtype=np.float64)
+        self.track_id=np.zeros(0,dtype=np.int64)
+        self.max_track_id=0
+        self.last_date=None
+
+    def load(self,state_file):
+
+        """Loads the state file. Returns False if it cannot be read."""
+
+        try:
+            with open(state_file) as fr:
+                state=json.load(fr)
+            self.jday=np.array(state["jday"],dtype=np.float64)
+            self.lon=np.array(state["lon"],dtype=np.float64)
+            self.lat=np.array(state["lat"],dtype=np.float64)
+            self.track_id=np.array(state["track_id"],dtype=np.int64)
+            self.max_track_id=int(state["max_track_id"])
+            self.last_date=None
+            if (state["last_date"] is not None):
+                self.last_date=datetime.strptime(state["last_date"],STATE_TFORMAT)
+        except (IOError,ValueError,KeyError,TypeError) as e:
+            LOG.error("Cannot read state file %s: %s",state_file,str(e))
+            return False
+        LOG.info("%i active feature(s) loaded from %s",len(self.jday),state_file)
+        return True
+
+    def save(self,state_file):
+
+        """Saves the state in state_file (replaced at once)."""
+
+        last_date=None
+        if (self.last_date is not None):
+            last_date=self.last_date.strftime(STATE_TFORMAT)
+        state={"last_date":last_date,
+               "max_track_id":int(self.max_track_id),
+               "jday":self.jday.tolist(),
+               "lon":self.lon.tolist(),
+               "lat":self.lat.tolist(),
+               "track_id":self.track_id.tolist()}
+        part=state_file + ".part"
+        with open(part,'w') as fw:
+            json.dump(state,fw)
+        os.rename(part,state_file)
+
+    def update(self,date_obs,feat_hg_long_deg,feat_hg_lat_deg,feat_area_deg2):
+
+        """
+        Tracks the features of a new file observed at date_obs.
+        Returns their track ids and levels of trust.
+        """
+
+        nold=len(self.jday)
+        nnew=len(feat_hg_long_deg)
+        new_jday=np.sum(tim2jd(date_obs))
+
+        # Active features first, as the earlier files in tracking
+        jday=np.concatenate([self.jday,np.repeat(new_jday,nnew).astype(np.float64)])
+        lon=np.concatenate([self.lon,np.array(feat_hg_long_deg,dtype=np.float64)])
+        lat=np.concatenate([self.lat,np.array(feat_hg_lat_deg,dtype=np.float64)])
+        valid=range(nold) + [nold + k for k in range(nnew)
+                             if not (feat_area_deg2[k] < self.area_min)]
+        pair_i,pair_j,terms=accepted_pairs(jday,lon,lat,valid,
+                                           radius=self.radius,dt_max=self.dt_max)
+        new_pair=(pair_i >= nold) | (pair_j >= nold)
+        pair_i=pair_i[new_pair] ; pair_j=pair_j[new_pair] ; terms=terms[new_pair]
+
+        # New features start with their own (temporary) track
+        first_id=self.max_track_id + 1
+        graph=track_graph(np.concatenate([self.track_id,
+                                          np.arange(first_id,first_id + nnew,dtype=np.int64)]))
+        for i,j in zip(pair_i,pair_j):
+            graph.union(i,j)
+        track_id=graph.track_id()
+        owner=np.where(pair_i >= nold,pair_i,pair_j)
+        partner=np.where(pair_i >= nold,pair_j,pair_i)
+        order=np.lexsort((partner,owner))
+        lvl_trust=trust_levels(nold + nnew,owner[order],terms[order])[nold:]
 
+        # New tracks are numbered in order
+        new_ids=np.unique(track_id[track_id >= first_id])
+        new_track=track_id >= first_id
+        track_id[new_track]=first_id + np.searchsorted(new_ids,track_id[new_track])
+        self.max_track_id+=len(new_ids)
 
+        # Features of the new file are active, the ones older than dt_max are not
+        active=[i for i in valid
+                if (np.isfinite(lon[i]) and np.isfinite(lat[i]) and
+                    np.abs(new_jday - jday[i])*24*3600 < self.dt_max)]
+        self.jday=jday[active]
+        self.lon=lon[active]
+        self.lat=lat[active]
+        self.track_id=track_id[active]
+        self.last_date=date_obs
+        return track_id[nold:], lvl_trust
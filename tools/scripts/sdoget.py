@@ -45,6 +45,13 @@ import re
 import glob
 import socket
 
+# http session of the sdoss libraries (keep-alive connections),
+# if they are in the python path
+try:
+    from hostpool import get_session
+except ImportError:
+    get_session = None
+
 try:
     import pyfits
     hasfits = True
@@ -162,6 +169,13 @@ def _getdata( message):
     wrong.
     """
     message = urllib.quote(urllib.unquote_plus(message),'&=')  # urlencode adds not understood +'s
+    if get_session is not None:
+        try:
+            response = get_session().request('http://'+netdrmsserver+':80'+info_url+'?'+message)
+            data = response.read()
+        except:
+            data = None
+        return data
     conn = httplib.HTTPConnection(netdrmsserver+':80')
     try:
         conn.request("GET", info_url+'?'+message)
@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+# -*- coding: ASCII -*-
+
+"""
+Test of the interrupted transfers of MyToolkit.download_file.
+
+A local http server sends the first bytes of a file then stalls,
+so that the read times out in the middle of the transfer. The
+download must not give up: the next try resumes the .part file
+with a Range request, whatever the file is named from (filename
+or Content-Disposition). A host which always stalls must open
+its circuit breaker, although it accepts the connections.
+
+Usage (from the repository root):
+    python tools/tests/test_download_file.py
+or with pytest:
+    pytest tools/tests/test_download_file.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+import SocketServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path[:0] = [os.path.join(ROOT, "lib", "python", "extra")]
+
+from MyToolkit import download_file
+from hostpool import get_breaker, BREAKER_FAILURES
+
+# Size of the file, and number of bytes sent before stalling
+SIZE = 3 * 1024 * 1024
+STALL = 1500000
+DATA = "".join([chr(i % 251) for i in range(SIZE)])
+
+
+class stalling_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Sends stall bytes then stalls, except for the Range requests."""
+
+    protocol_version = "HTTP/1.1"
+    requests = []
+    # If True, the Range requests stall as well
+    always = False
+    stall = STALL
+
+    def do_GET(self):
+        content_range = self.headers.getheader("Range")
+        self.requests.append(content_range)
+        offset = 0
+        if (content_range):
+            offset = int(content_range.split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             "bytes %i-%i/%i" % (offset, SIZE - 1, SIZE))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Disposition",
+                         "attachment; filename=\"a.fits\"")
+        self.send_header("Content-Length", str(SIZE - offset))
+        self.end_headers()
+        try:
+            if (content_range) and not (self.always):
+                self.wfile.write(DATA[offset:])
+                return
+            self.wfile.write(DATA[offset:offset + self.stall])
+            self.wfile.flush()
+            time.sleep(3)
+        except Exception:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class threading_server(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_server(handler):
+    server = threading_server(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:%i/get" % (server.server_port)
+
+
+def stalled_download(filename):
+    server, url = start_server(stalling_handler)
+    directory = tempfile.mkdtemp()
+    del stalling_handler.requests[:]
+    try:
+        target = download_file(url, target_directory=directory,
+                               filename=filename, timeout=1, quiet=True)
+        assert target == os.path.join(directory, "a.fits")
+        with (open(target, "rb")) as fr:
+            assert fr.read() == DATA
+        assert not (os.path.isfile(target + ".part"))
+        # The first request stalls, the second one resumes it
+        requests = stalling_handler.requests
+        assert len(requests) == 2 and requests[0] is None
+        assert requests[1].startswith("bytes=")
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+def test_resume_named():
+    stalled_download("a.fits")
+
+
+def test_resume_content_disposition():
+    stalled_download("")
+
+
+class always_stalling_handler(stalling_handler):
+    always = True
+    stall = 1000
+
+
+def test_breaker_opens():
+    server, url = start_server(always_stalling_handler)
+    directory = tempfile.mkdtemp()
+    breaker = get_breaker(url)
+    try:
+        target = download_file(url, target_directory=directory,
+                               filename="a.fits", timeout=1, quiet=True,
+                               tries=BREAKER_FAILURES + 1)
+        assert target == ""
+        assert breaker.status()["state"] == breaker.OPEN
+    finally:
+        # Close the circuit of the local host for the other tests
+        breaker.success()
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+if (__name__ == "__main__"):
+    test_resume_named()
+    test_resume_content_disposition()
+    test_breaker_opens()
+    print "Stalled transfers resumed"
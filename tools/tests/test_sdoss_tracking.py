@@ -0,0 +1,158 @@
+#! /usr/bin/env python
+# -*- coding: ASCII -*-
+
+"""
+Numerical equivalence test of src/sdoss_tracking.tracking.
+
+tracking hashes the features on a grid to compare only the nearby
+pairs (candidate_pairs), compares them by blocks of array operations
+(match_pairs) and merges the tracks in a union-find track_graph.
+This test checks it against reference_tracking below, which is the
+former implementation comparing every pair of features in nested
+python loops, on random windows of features (drifting sunspots with
+noise, features under area_min, repeated input track ids, NaN
+coordinates, zero radius).
+
+The results must be identical, not only close: the track ids are
+compared exactly and the levels of trust bit for bit, as the kernel
+uses the same floating-point operations in the same order: squares
+with np.power (pow(), as ** on numpy scalars, not a multiplication
+as ** on arrays), and the terms of each feature summed one by one
+with np.cumsum.
+
+Usage (from the repository root):
+    python tools/tests/test_sdoss_tracking.py [ntrial]
+or with pytest:
+    pytest tools/tests/test_sdoss_tracking.py
+"""
+
+import os
+import sys
+import random
+from datetime import datetime, timedelta
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+sys.path[:0] = [os.path.join(ROOT, "src"),
+                os.path.join(ROOT, "lib", "python", "extra")]
+
+from ssw import tim2jd
+from sdoss_tracking import pre_hg_long, tracking
+
+# Number of random windows tested
+NTRIAL = 50
+
+
+def reference_tracking(date_obs, feat_x_pix, feat_y_pix,
+                       feat_hg_long_deg, feat_hg_lat_deg, feat_area_deg2,
+                       radius=5.0, dt_max=86400, area_min=0.0, track_id=None):
+
+    """Former implementation of tracking (all pairs of features)."""
+
+    nfeat = len(date_obs)
+    if (track_id is None) or (len(track_id) == 0):
+        track_id = np.arange(1, nfeat + 1, dtype=np.int64)
+    else:
+        track_id = np.array(track_id, dtype=np.int64)
+
+    lvl_trust = np.zeros(nfeat, dtype=np.float) ; processed = []
+    for i, current_date_i in enumerate(date_obs):
+
+        if (feat_area_deg2[i] < area_min): continue
+        feat_long_i = feat_hg_long_deg[i]
+        feat_lat_i = feat_hg_lat_deg[i]
+        lvl_trust_i = 0.0 ; count_i = 0.0
+        for j, current_date_j in enumerate(date_obs):
+
+            if (feat_area_deg2[j] < area_min): continue
+            if (i == j): continue
+            if ([i, j] in processed) or ([j, i] in processed): continue
+            feat_long_j = feat_hg_long_deg[j]
+            feat_lat_j = feat_hg_lat_deg[j]
+            pre_long_i = pre_hg_long(feat_long_i, feat_lat_i,
+                                     current_date_i, current_date_j)
+
+            dist = np.sqrt((feat_long_j - pre_long_i)**2 +
+                           (feat_lat_j - feat_lat_i)**2)
+            dt_ij = np.abs(np.sum(tim2jd(current_date_i)) -
+                           np.sum(tim2jd(current_date_j)))*24*3600
+
+            if (dist <= radius) and (dt_ij < dt_max):
+                cond_k = (track_id == track_id[i]) | (track_id == track_id[j])
+                k = np.where(cond_k)
+                track_id[k] = np.min(track_id[k])
+                lvl_trust_i += 0.5*((1.0 - 0.5*(dist/radius)) +
+                                    (1.0 - 0.5*(dt_ij/dt_max)))
+                count_i += 1.0
+                processed.append([i, j])
+
+        if (count_i > 0.0): lvl_trust[i] = 100.0*(lvl_trust_i/count_i)
+
+    return track_id, lvl_trust
+
+
+def random_window(seed):
+
+    """
+    Returns the arguments of tracking for a random window of
+    sunspots rotating with the Sun, observed in 1 to 8 files.
+    """
+
+    rand = random.Random(seed)
+    start = datetime(2014, 1, 1) + timedelta(seconds=rand.randint(0, 10**7))
+    cadence = rand.choice([3600, 7200, 21600, 43200, 86400])
+    spots = [(rand.uniform(-80, 80), rand.uniform(-40, 40))
+             for k in range(rand.randint(1, 60))]
+    args = {"date_obs": [], "feat_x_pix": [], "feat_y_pix": [],
+            "feat_hg_long_deg": [], "feat_hg_lat_deg": [],
+            "feat_area_deg2": []}
+    for n in range(rand.randint(1, 8)):
+        current_date = start + timedelta(seconds=n*cadence)
+        days = float(n*cadence)/86400.0
+        for k, (lon, lat) in enumerate(spots):
+            if (rand.random() < 0.2): continue
+            args["date_obs"].append(current_date)
+            args["feat_x_pix"].append(k)
+            args["feat_y_pix"].append(n)
+            args["feat_hg_long_deg"].append(lon + 14.0*days + rand.gauss(0, 2))
+            args["feat_hg_lat_deg"].append(lat + rand.gauss(0, 1.5))
+            args["feat_area_deg2"].append(rand.choice([0.5, 2.0, 10.0]))
+    if (args["feat_hg_long_deg"]) and (rand.random() < 0.2):
+        args["feat_hg_long_deg"][0] = float("nan")
+    options = {"radius": rand.choice([0.0, 2.0, 5.0, 10.0]),
+               "dt_max": rand.choice([3600.0, 86400.0, 200000.0]),
+               "area_min": rand.choice([0.0, 1.0]),
+               "track_id": None}
+    if (rand.random() < 0.3):
+        nfeat = len(args["date_obs"])
+        options["track_id"] = [rand.randint(1, nfeat) for i in range(nfeat)]
+    return args, options
+
+
+def check_window(seed):
+    args, options = random_window(seed)
+    with np.errstate(all='ignore'):
+        track_id, lvl_trust = tracking(**dict(args, **options))
+        ref_track_id, ref_lvl_trust = reference_tracking(**dict(args, **options))
+    assert (track_id == ref_track_id).all(), \
+        "track_id differs for window %i" % (seed)
+    assert lvl_trust.tobytes() == ref_lvl_trust.tobytes(), \
+        "lvl_trust differs for window %i" % (seed)
+
+
+def test_equivalence():
+    for seed in range(NTRIAL):
+        check_window(seed)
+
+
+def test_empty_window():
+    track_id, lvl_trust = tracking([], [], [], [], [], [])
+    assert len(track_id) == 0 and len(lvl_trust) == 0
+
+
+if (__name__ == "__main__"):
+    if (len(sys.argv) > 1):
+        NTRIAL = int(sys.argv[1])
+    test_equivalence()
+    test_empty_window()
+    print "%i window(s): tracking is identical to the reference" % (NTRIAL)